@@ -99,7 +99,9 @@ def transform_json(input_list):
 class AircraftPerformancePreprocessor(BasePreprocessor):
     def __init__(self, use_airline_lut=True, no_cache=False) -> None:
         super().__init__(no_cache)
+        self.use_airline_lut = use_airline_lut
         base_dir = Path(__file__).parents[1] / "additional_data" / "aircraft_data"
+        self.base_dir = base_dir
         if not base_dir.exists():
             raise FileNotFoundError(f"Can not find {base_dir}")
         self.info = json.load(open(base_dir / "aircraft_info.json"))
@@ -146,6 +148,16 @@ class AircraftPerformancePreprocessor(BasePreprocessor):
             else {}
         )
 
+    def cache_config(self) -> dict:
+        return {"use_airline_lut": self.use_airline_lut}
+
+    def cache_dependencies(self) -> list:
+        # manual_aircraft_info.json is edited by hand
+        return [
+            self.base_dir / "aircraft_info.json",
+            self.base_dir / "manual_aircraft_info.json",
+        ]
+
     @cache
     def props_for_aircraft(self, aircraft_type: str) -> dict:
         airline, type = aircraft_type.split("_")
@@ -18,6 +18,10 @@ class OpenAPAircraftPerformancePreprocessor(BasePreprocessor):
             Path(__file__).parent.parent / "additional_data" / "aircraft_data"
         )
 
+    def cache_dependencies(self) -> list:
+        # the yaml files of the aircraft and engines that openap does not know
+        return [self.base_path]
+
     @cache
     def props_for_aircraft(self, aircraft_type: str) -> dict:
         try:
@@ -52,6 +52,15 @@ class AirportPreprocessor(BasePreprocessor):
         self.compute_distance_features = compute_distance_features
         self.tzf = TimezoneFinder()
 
+    def cache_config(self) -> dict:
+        return {
+            "compute_timezone_features": self.compute_timezone_features,
+            "compute_distance_features": self.compute_distance_features,
+        }
+
+    def cache_dependencies(self) -> list:
+        return [base_path / "additional_data/airport_data/airports.csv"]
+
     @cache
     def get_airport_data(self, code):
         if len(code) == 3:
@@ -1,12 +1,12 @@
 from abc import ABC, abstractmethod
-from joblib import Memory
 from utils.dataset import Dataset
-
-# max 2GB cache per Preprocessor
-memory = Memory(".cache", bytes_limit="2G", verbose=1)
+from preprocessing.preprocessor_cache import cached_apply, forget_output
 
 
 class BasePreprocessor(ABC):
+    # increase when the output changes without a change of the code or of the cache_dependencies, so the cache is not used
+    cache_version = 1
+
     def __init__(self, no_cache=False) -> None:
         super().__init__()
         self.no_cache = no_cache
@@ -16,9 +16,19 @@ class BasePreprocessor(ABC):
         """Should modify the dataset and return the updated version"""
         raise NotImplementedError()
 
+    def cache_config(self) -> dict:
+        """Constructor arguments that change the output, they are part of the cache key"""
+        return {}
+
+    def cache_dependencies(self) -> list:
+        """Files that are read by process, the cached outputs are not used once they change"""
+        return []
+
     def apply(self, dataset: Dataset) -> Dataset:
         if self.no_cache:
-            apply_func = self.process
-        else:
-            apply_func = memory.cache(self.process, ignore=["self"])
-        return apply_func(dataset)
+            # the frame may be changed in place, it is no cached output anymore
+            forget_output(dataset.df)
+            dataset = self.process(dataset)
+            forget_output(dataset.df)
+            return dataset
+        return cached_apply(self, dataset)
@@ -0,0 +1,159 @@
+#
+# Fuel burn over the whole trajectory, the fuel stage of the trajectory batch job (--stage fuel)
+# museum/notebooks/estimate_ff.py created a new estimator for every flight and estimate_fuel_flow in
+# trajectory_batchprocessing.py runs flight.fuelflow one flight at a time. Here the points of a whole chunk of flights are
+# stacked, every aircraft type of the chunk gets one array-valued OpenAP FuelFlow.enroute call, and the fuel burnt is
+# integrated per flight with grouped cumulative sums. The FuelFlow models are created once per worker and aircraft type.
+# The take-off weight is what the models predict, so all flights of a type are flown at the same reference mass
+# (halfway between MLW and MTOW, like OpenAPFuelFlowPreprocessor), the features are relative between flights of a type.
+# The cruise fuel is the fuel of the cruise segment of the trajectory features (FlightBatch.level_segments).
+#
+
+from functools import cache
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+try:
+    import openap
+except ImportError:
+    # only needed for the fuel stage
+    openap = None
+
+from preprocessing.trajectory_engine import (
+    FlightBatch,
+    label_phases,
+    segment_first,
+    segment_max,
+    segment_mean,
+    segment_sum,
+    take,
+)
+from preprocessing.trajectory_phases import CLIMB, DESCENT, GROUND
+
+# increase when fuel_burn_features changes, so the store recomputes all flights
+FUEL_BURN_VERSION = 2
+FALLBACK_TYPE = "A320"  # model of the aircraft types that OpenAP does not know
+MS_IN_KT = 1.94384
+MIN_SPEED_KT = 50  # slower points (taxi) do not burn fuel in the en-route model
+
+FUEL_BURN_FEATURES = [
+    "fuel_burnt_kg",
+    "fuel_climb_kg",
+    "fuel_to_cruise_kg",
+    "fuel_cruise_kg",
+    "fuel_descent_kg",
+    "fuel_mean_flow_kg_s",
+    "fuel_max_flow_kg_s",
+    "fuel_airborne_time_s",
+]
+FUEL_BURN_SCHEMA = pa.schema(
+    [("flight_id", pa.int64())]
+    + [(column, pa.float64()) for column in FUEL_BURN_FEATURES]
+    + [("fuel_model", pa.string())]
+)
+
+
+@cache
+def fuel_flow_model(typecode: str) -> tuple:
+    # (FuelFlow, reference mass in kg, type of the model) of an aircraft type, created once per process
+    try:
+        fuelflow = openap.FuelFlow(ac=typecode)
+        props = openap.prop.aircraft(typecode)
+        model = typecode
+    except (ValueError, KeyError, AttributeError):
+        # ValueError for the types that OpenAP does not know, the others for type codes that are not a string
+        fuelflow = openap.FuelFlow(ac=FALLBACK_TYPE)
+        props = openap.prop.aircraft(FALLBACK_TYPE)
+        model = FALLBACK_TYPE
+    mass = props["mlw"] + (props["mtow"] - props["mlw"]) / 2
+    return fuelflow, mass, model
+
+
+def true_airspeed(batch: FlightBatch) -> np.ndarray:
+    # groundspeed minus the wind (u/v in m/s), the groundspeed where the wind is missing
+    track = np.radians(batch.track)
+    u_air = batch.groundspeed * np.sin(track) - batch.u_wind * MS_IN_KT
+    v_air = batch.groundspeed * np.cos(track) - batch.v_wind * MS_IN_KT
+    tas = np.hypot(u_air, v_air)
+    return np.where(np.isnan(tas), batch.groundspeed, tas)
+
+
+def fuel_flow(batch: FlightBatch, typecodes) -> tuple:
+    # fuel flow in kg/s of every point, one enroute call per aircraft type, and the model type of every flight
+    typecodes = np.asarray(typecodes, dtype=object)
+    models = np.empty(len(batch), dtype=object)
+    flow = np.zeros(len(batch.group))
+    tas = true_airspeed(batch)
+    vertical_rate = np.nan_to_num(batch.vertical_rate)
+    airborne = (
+        (batch.groundspeed >= MIN_SPEED_KT) & ~np.isnan(batch.altitude) & ~np.isnan(tas)
+    )
+    point_types = typecodes[batch.group]
+    for typecode in np.unique(typecodes):
+        fuelflow, mass, model = fuel_flow_model(typecode)
+        models[typecodes == typecode] = model
+        points = airborne & (point_types == typecode)
+        if not points.any():
+            continue
+        flow[points] = fuelflow.enroute(
+            mass=np.full(points.sum(), mass),
+            tas=tas[points],
+            alt=batch.altitude[points],
+            vs=vertical_rate[points],
+        )
+    # points outside the range of the model
+    return np.nan_to_num(flow), models, airborne
+
+
+def fuel_burn_features(trajectories: pd.DataFrame, flight_lookup: dict) -> pd.DataFrame:
+    # fuel burn of all flights of the frame at once, trapezoidal integration of the fuel flow between consecutive points
+    trajectories = trajectories[trajectories["flight_id"].isin(list(flight_lookup))]
+    batch = FlightBatch(trajectories)
+    n = len(batch)
+    group = batch.group
+    typecodes = [flight_lookup[flight_id][2] for flight_id in batch.flight_ids.tolist()]
+    # flights without an aircraft type get the fallback model, np.unique can not sort None/NaN between the strings
+    typecodes = pd.Series(typecodes, dtype=object).fillna(FALLBACK_TYPE).tolist()
+    flow, models, airborne = fuel_flow(batch, typecodes)
+
+    # fuel of the interval from every point to the next point of the same flight
+    has_next = np.r_[batch.has_previous[1:], False]
+    next_flow = np.r_[flow[1:], 0.0]
+    dt = np.where(has_next, np.r_[batch.time[1:], 0.0] - batch.time, 0.0)
+    burnt = np.where(has_next, (flow + next_flow) / 2 * dt, 0.0)
+    # fuel burnt from the first point of the flight until each point, the cumulative sum restarts at every flight
+    cumulative = np.cumsum(burnt) - burnt
+    cumulative -= np.repeat(cumulative[batch.starts], batch.counts)
+
+    phase = label_phases(batch)
+    # the longest level segment above CRUISE_MIN_ALTITUDE_FT, the cruise of cruise_features without its fallback for
+    # flights that stay below
+    segments = batch.level_segments
+    cruise = segments.point_mask(segments.longest())
+    return pd.DataFrame(
+        {
+            "flight_id": batch.flight_ids.astype(np.int64),
+            # burnt is 0 for the last point of every flight
+            "fuel_burnt_kg": cumulative[batch.ends - 1] + burnt[batch.ends - 1],
+            "fuel_climb_kg": segment_sum(burnt, group, n, phase == CLIMB),
+            # fuel until the first cruise point, NaN for flights without cruise
+            "fuel_to_cruise_kg": take(cumulative, segment_first(cruise, group, n)),
+            "fuel_cruise_kg": segment_sum(burnt, group, n, cruise),
+            "fuel_descent_kg": segment_sum(burnt, group, n, phase == DESCENT),
+            "fuel_mean_flow_kg_s": segment_mean(flow, group, n, airborne),
+            "fuel_max_flow_kg_s": segment_max(flow, group, n, airborne),
+            "fuel_airborne_time_s": segment_sum(
+                dt, group, n, airborne & (phase != GROUND)
+            ),
+            "fuel_model": models.astype(str),
+        }
+    )[FUEL_BURN_SCHEMA.names]
+
+
+def fuel_burn_from_frames(frames: list) -> pd.DataFrame:
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return FUEL_BURN_SCHEMA.empty_table().to_pandas()
+    return pd.concat(frames, ignore_index=True)
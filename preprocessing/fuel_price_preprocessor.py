@@ -9,6 +9,12 @@ base_dir = root_dir / "additional_data" / "airport_data"
 
 
 class FuelPricePreprocessor(BasePreprocessor):
+    def cache_dependencies(self) -> list:
+        return [
+            base_dir / "fuel_prices_20_06_2022.csv",
+            base_dir / "UN_fuel_data.csv",
+            base_dir / "country_codes.csv",
+        ]
 
     def process(self, dataset: Dataset) -> Dataset:
         print("Adding fuel price data...")
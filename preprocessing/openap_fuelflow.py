@@ -1,19 +1,11 @@
-from openap import FuelFlow
 from preprocessing.base_preprocessor import BasePreprocessor
+from preprocessing.fuel_burn import FALLBACK_TYPE, fuel_flow_model
 from utils.dataset import Dataset
 from pathlib import Path
-from tqdm import tqdm
-from functools import cache
+import numpy as np
 import pandas as pd
 
 
-@cache
-def ff_for_ac(ac):
-    # as so little aircraft are supported, we choose a common baseline.
-    fuelflow = FuelFlow(ac="A320")
-    return fuelflow
-
-
 class OpenAPFuelFlowPreprocessor(BasePreprocessor):
     def __init__(self, no_cache=False) -> None:
         super().__init__(no_cache)
@@ -22,16 +14,25 @@ class OpenAPFuelFlowPreprocessor(BasePreprocessor):
         )
 
     def process(self, dataset: Dataset) -> Dataset:
-        result = []
-        for _, row in tqdm(dataset.df.iterrows(), total=len(dataset.df)):
-            fuelflow = ff_for_ac(row["aircraft_type"])
-            alt = row["cruise_altitude"]
-            tas = row["mean_cruise_speed"] + row["average_headwind"]
-            open_ap_cruise_mass = row["openap_mlw"] + (
-                (row["openap_mtow"] - row["openap_mlw"]) / 2
+        df = dataset.df
+        alt = df["cruise_altitude"].to_numpy(dtype="float64")
+        tas = (df["mean_cruise_speed"] + df["average_headwind"]).to_numpy(
+            dtype="float64"
+        )
+        open_ap_cruise_mass = (
+            df["openap_mlw"] + ((df["openap_mtow"] - df["openap_mlw"]) / 2)
+        ).to_numpy(dtype="float64")
+        # one enroute call per aircraft type with the cached FuelFlow of the type (A320 if OpenAP has no model)
+        # groupby drops missing keys, flights without an aircraft type get the A320 model as well
+        aircraft_types = df["aircraft_type"].fillna(FALLBACK_TYPE)
+        groups = aircraft_types.groupby(aircraft_types).indices
+        result = np.full(len(df), np.nan)
+        for aircraft_type, rows in groups.items():
+            fuelflow, _, _ = fuel_flow_model(aircraft_type)
+            result[rows] = fuelflow.enroute(
+                mass=open_ap_cruise_mass[rows], tas=tas[rows], alt=alt[rows]
             )
-            ff = fuelflow.enroute(mass=open_ap_cruise_mass, tas=tas, alt=alt)
-            result.append(ff)
 
-        dataset.df["cruise_fuel_flow_calculated"] = pd.Series(result)
+        # aligned by index, which is not 0..n-1 after the merges and filters before
+        dataset.df["cruise_fuel_flow_calculated"] = pd.Series(result, index=df.index)
         return dataset
@@ -11,6 +11,8 @@ base_dir = root_dir / "additional_data" / "airport_data"
 
 
 class PaxFlowPreprocessor(BasePreprocessor):
+    def cache_dependencies(self) -> list:
+        return [base_dir / "estat_avia_tf_apal_en.csv"]
 
     @cache
     def load_statistics(self):
@@ -11,8 +11,16 @@ class PayloadPredictionPreprocessor(BasePreprocessor):
     def __init__(self, model_path, no_cache=False) -> None:
         super().__init__(no_cache)
         assert Path(model_path).exists()
+        self.model_path = Path(model_path)
         self.model = TabularPredictor.load(model_path)
 
+    def cache_config(self) -> dict:
+        return {"model_path": str(self.model_path)}
+
+    def cache_dependencies(self) -> list:
+        # a retrained model is saved to the same directory
+        return [self.model_path]
+
     def process(self, dataset: Dataset) -> Dataset:
         data = dataset.df.copy()
 
@@ -0,0 +1,198 @@
+#
+# Content-addressed cache of the preprocessor outputs, used by BasePreprocessor.apply
+# joblib hashed the whole Dataset on every call and ignored the constructor arguments and code changes, so it was switched off.
+# Here an output is stored under a key of: a fingerprint of the input frame, the class, the
+# constructor arguments it lists in cache_config, the source files of the class, its base classes and the project modules
+# they import (directly or through other project modules), its cache_version and the size/mtime of the
+# files it lists in cache_dependencies. A changed input, argument, code or data file gives a new key, so nothing stale is read.
+# Hashing every value of the input took about a second per preprocessor, so the fingerprint only hashes the shape, the
+# dtypes, the index, the flight_ids and a sample of the rows, plus the key of the preprocessor whose output the frame is.
+# Along the preprocessor chain every input is therefore identified by the key of the step before it, and only the first
+# frame (read from the csv files) relies on the sample.
+# The outputs are parquet files, the least recently used ones are removed once the cache is larger than CACHE_BYTES.
+#
+
+import hashlib
+import inspect
+import os
+import sys
+import uuid
+import weakref
+from functools import cache
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+
+root_dir = Path(__file__).parent.parent.absolute()
+cache_dir = root_dir / ".cache" / "preprocessors"
+
+CACHE_BYTES = 2 * 1024**3  # 2GB, same limit as the joblib cache before
+SAMPLE_ROWS = 1000  # rows of the input frame whose values are hashed
+
+# id of a frame returned by cached_apply -> (weak reference to the frame, its cache key)
+_output_keys = {}
+
+
+def remember_output(df: pd.DataFrame, key: str) -> None:
+    _output_keys[id(df)] = (weakref.ref(df), key)
+
+
+def forget_output(df: pd.DataFrame) -> None:
+    # for frames that are changed outside cached_apply, e.g. by a preprocessor with no_cache
+    _output_keys.pop(id(df), None)
+
+
+def upstream_key(df: pd.DataFrame) -> str:
+    # cache key of the preprocessor that returned df, None for other frames
+    entry = _output_keys.get(id(df))
+    if entry is None or entry[0]() is not df:
+        return None
+    return entry[1]
+
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    # hash of the shape, the column names and dtypes, the index, the flight_ids, the values of a sample of the rows
+    # and the key of the preprocessor that returned the frame
+    digest = hashlib.sha256()
+    digest.update(
+        repr(
+            (df.shape, list(df.columns), list(map(str, df.dtypes)), upstream_key(df))
+        ).encode()
+    )
+    digest.update(pd.util.hash_pandas_object(df.index).values.tobytes())
+    if "flight_id" in df:
+        digest.update(
+            pd.util.hash_pandas_object(df["flight_id"], index=False).values.tobytes()
+        )
+    sample = df.iloc[:: max(len(df) // SAMPLE_ROWS, 1)]
+    for i in range(sample.shape[1]):
+        column = sample.iloc[:, i]
+        try:
+            hashes = pd.util.hash_pandas_object(column, index=False)
+        except TypeError:
+            # unhashable values, e.g. lists
+            hashes = pd.util.hash_pandas_object(column.astype(str), index=False)
+        digest.update(hashes.values.tobytes())
+    return digest.hexdigest()
+
+
+def project_file(module) -> Path:
+    # source file of a module of this repository, None for the standard library and installed packages
+    source_file = getattr(module, "__file__", None)
+    if source_file is None or not source_file.endswith(".py"):
+        return None
+    source_file = Path(source_file).resolve()
+    if root_dir not in source_file.parents or "site-packages" in source_file.parts:
+        return None
+    return source_file
+
+
+def project_imports(module) -> set:
+    # project modules that module uses, as module (import x) or through a name imported from it (from x import y)
+    imported = set()
+    for value in list(vars(module).values()):
+        name = (
+            value.__name__
+            if inspect.ismodule(value)
+            else getattr(value, "__module__", None)
+        )
+        used = sys.modules.get(name) if isinstance(name, str) else None
+        if used is not None and used is not module and project_file(used) is not None:
+            imported.add(used)
+    return imported
+
+
+@cache
+def source_hash(cls: type) -> str:
+    # hash of the modules that define the class and its base classes and of all project modules they import, so a
+    # change of a helper like fuel_burn.py or utils/ gives a new key as well
+    modules = {sys.modules.get(klass.__module__) for klass in cls.__mro__} - {None}
+    todo = [module for module in modules if project_file(module) is not None]
+    seen = set(todo)
+    while todo:
+        for used in project_imports(todo.pop()):
+            if used not in seen:
+                seen.add(used)
+                todo.append(used)
+    digest = hashlib.sha256()
+    for source_file in sorted(project_file(module) for module in seen):
+        digest.update(Path(source_file).read_bytes())
+    return digest.hexdigest()
+
+
+def file_state(path: Path) -> tuple:
+    # size and mtime of a file, of every file below it for a directory (e.g. a saved model)
+    path = Path(path)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return (str(path), None)
+    if path.is_dir():
+        return (
+            str(path),
+            [
+                file_state(entry)
+                for entry in sorted(path.rglob("*"))
+                if not entry.is_dir()
+            ],
+        )
+    return (str(path), stat.st_size, stat.st_mtime_ns)
+
+
+def cache_key(preprocessor, df: pd.DataFrame) -> str:
+    cls = type(preprocessor)
+    parts = (
+        frame_fingerprint(df),
+        f"{cls.__module__}.{cls.__qualname__}",
+        repr(sorted(preprocessor.cache_config().items())),
+        source_hash(cls),
+        preprocessor.cache_version,
+        [file_state(path) for path in preprocessor.cache_dependencies()],
+    )
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def evict(path: Path = cache_dir, max_bytes: int = CACHE_BYTES) -> None:
+    # remove the least recently used outputs (a hit touches its file) until the cache fits into max_bytes
+    entries = []
+    for entry in path.glob("*.parquet"):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        entry.unlink(missing_ok=True)
+        total -= size
+
+
+def cached_apply(preprocessor, dataset, path: Path = cache_dir):
+    # dataset after preprocessor.process, read from the cache if the same input was processed before
+    name = type(preprocessor).__name__
+    key = cache_key(preprocessor, dataset.df)
+    entry = Path(path) / f"{key}.parquet"
+    if entry.exists():
+        dataset.df = pd.read_parquet(entry)
+        os.utime(entry)
+        remember_output(dataset.df, key)
+        print(f"{name}: Loaded from cache.")
+        return dataset
+
+    dataset = preprocessor.process(dataset)
+    remember_output(dataset.df, key)
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = entry.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        dataset.df.to_parquet(tmp_file)
+    except (pa.ArrowException, ValueError, TypeError) as e:
+        # e.g. columns with mixed types, the output is simply not cached
+        tmp_file.unlink(missing_ok=True)
+        print(f"{name}: Output can not be cached ({e}).")
+        return dataset
+    tmp_file.replace(entry)
+    evict(Path(path))
+    return dataset
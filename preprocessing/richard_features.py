@@ -14,6 +14,9 @@ trajectory_data_file = (
 
 
 class RichardTrajectoryPreprocessor(BasePreprocessor):
+    def cache_dependencies(self) -> list:
+        return [trajectory_data_file]
+
     def process(self, dataset: Dataset) -> Dataset:
         # check if the additional data directory contains the trajectory data
         if not trajectory_data_file.exists():
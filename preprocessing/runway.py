@@ -9,6 +9,9 @@ root_dir = Path(__file__).parent.parent
 
 
 class RunwayInfoPreprocessor(BasePreprocessor):
+    def cache_dependencies(self) -> list:
+        return [root_dir / "additional_data" / "runway_data" / "runways.csv"]
+
     @cache
     def info_for_airport(self, airport):
         file = root_dir / "additional_data" / "runway_data" / "runways.csv"
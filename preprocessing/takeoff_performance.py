@@ -0,0 +1,324 @@
+#
+# Runway usage and takeoff performance per flight, the takeoff stage of the trajectory batch job (--stage takeoff)
+# Promoted from museum/notebooks/takeoff_info_mp.py: the takeoff segment of the flight is detected with traffic, the end of
+# the acceleration on the runway is the last LEVEL point of the segment, and the runway left from there to the runway end
+# gives the runway length used. The climb after it is summarised like in the notebook.
+# The runway is identified from the position and track at the end of the acceleration with a BallTree over all runway ends of
+# runways.csv, for all flights of a chunk in one query, instead of filtering the csv for every flight.
+#
+
+from functools import cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from sklearn.neighbors import BallTree
+
+from preprocessing.trajectory_engine import EARTH_RADIUS_M, haversine_m
+
+root_dir = Path(__file__).parent.parent.absolute()
+runway_file = root_dir / "additional_data" / "runway_data" / "runways.csv"
+
+# increase when takeoff_performance changes, so the store recomputes all flights
+TAKEOFF_PERFORMANCE_VERSION = 2
+FT_IN_M = 3.28084
+RUNWAY_CANDIDATES = 32  # nearest runway ends that are checked for the airport and heading, more than any airport has
+RUNWAY_MAX_HEADING_DIFF = 30  # degrees between the track at the end of the acceleration and the runway heading
+RUNWAY_MAX_OFFSET_M = (
+    300  # max distance of the end of the acceleration from the runway (centreline)
+)
+
+CLIMB_FEATURES = [
+    "climb_mean_climb",
+    "climb_median_climb",
+    "climb_max_climb",
+    "climb_mean_alt",
+    "climb_median_alt",
+    "climb_max_alt",
+    "climb_min_tas",
+    "climb_mean_tas",
+    "climb_median_tas",
+    "climb_max_tas",
+    "climb_min_gs",
+    "climb_mean_gs",
+    "climb_median_gs",
+    "climb_max_gs",
+    "climb_mean_alt_climb",
+    "climb_median_alt_climb",
+    "climb_max_alt_climb",
+    "climb_total_altitude_climbed",
+    "climb_dist_to_rwy_end",
+    "climb_dist_to_takeoff_point",
+]
+TAKEOFF_PERFORMANCE_FEATURES = [
+    "runway_heading",
+    "runway_length_ft",
+    "takeoff_latitude",
+    "takeoff_longitude",
+    "takeoff_track",
+    "takeoff_TAS",
+    "takeoff_groundspeed",
+    "takeoff_cumdist",
+    "runway_ft_left",
+    "runway_used",
+    "runway_percent_used",
+    *CLIMB_FEATURES,
+]
+TAKEOFF_PERFORMANCE_SCHEMA = pa.schema(
+    [("flight_id", pa.int64()), ("runway", pa.string())]
+    + [(column, pa.float64()) for column in TAKEOFF_PERFORMANCE_FEATURES]
+    + [("info", pa.string())]
+)
+# columns of the records of the workers, the runway features are added by add_runway_features
+RECORD_COLUMNS = [
+    "flight_id",
+    "adep",
+    "climb_end_latitude",
+    "climb_end_longitude",
+    *[
+        column
+        for column in TAKEOFF_PERFORMANCE_FEATURES
+        if not column.startswith("runway_") and column != "climb_dist_to_rwy_end"
+    ],
+    "info",
+]
+
+
+@cache
+def runway_ends(file: Path = runway_file) -> pd.DataFrame:
+    # one row per runway end (both directions of every runway) of runways.csv from ourairports
+    runways = pd.read_csv(file)
+    ends = [
+        pd.DataFrame(
+            {
+                "airport_ident": runways["airport_ident"],
+                "ident": runways[f"{end}_ident"],
+                "end": end,
+                "latitude": runways[f"{end}_latitude_deg"],
+                "longitude": runways[f"{end}_longitude_deg"],
+                "elevation_ft": runways[f"{end}_elevation_ft"],
+                # runways without a heading in the csv point from this end to the other end
+                "heading": runways[f"{end}_heading_degT"].fillna(
+                    pd.Series(
+                        initial_bearing(
+                            runways[f"{end}_latitude_deg"].values,
+                            runways[f"{end}_longitude_deg"].values,
+                            runways[f"{other}_latitude_deg"].values,
+                            runways[f"{other}_longitude_deg"].values,
+                        ),
+                        index=runways.index,
+                    )
+                ),
+                "length_ft": runways["length_ft"],
+                "closed": runways["closed"].astype(bool),
+            }
+        )
+        for end, other in (("le", "he"), ("he", "le"))
+    ]
+    return pd.concat(ends, ignore_index=True).dropna(subset=["ident"])
+
+
+class RunwayIndex:
+    # BallTree (haversine metric) over the open runway ends, resolves whole batches of positions to runways in one query
+
+    def __init__(self, ends: pd.DataFrame = None) -> None:
+        ends = runway_ends() if ends is None else ends
+        ends = ends[~ends["closed"]].dropna(subset=["latitude", "longitude"])
+        self.ends = ends.reset_index(drop=True)
+        self.airport = self.ends["airport_ident"].to_numpy(dtype=object)
+        self.heading = self.ends["heading"].to_numpy(dtype=np.float64)
+        self.latitude = self.ends["latitude"].to_numpy(dtype=np.float64)
+        self.longitude = self.ends["longitude"].to_numpy(dtype=np.float64)
+        self.length_ft = self.ends["length_ft"].to_numpy(dtype=np.float64)
+        self.tree = BallTree(
+            np.radians(np.c_[self.latitude, self.longitude]), metric="haversine"
+        )
+
+    def query(
+        self, latitude, longitude, track=None, airports=None, k=RUNWAY_CANDIDATES
+    ) -> pd.DataFrame:
+        # the runway end of every position, among its k nearest ends: only ends of airports[i] (if given) and only ends
+        # whose heading is within RUNWAY_MAX_HEADING_DIFF of track[i] (if given), i.e. the runway the aircraft rolls on
+        # of these the end closest to the extended centreline, without a track simply the nearest end
+        # positions further than RUNWAY_MAX_OFFSET_M from any runway get NaN
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        n = len(latitude)
+        end = np.full(n, -1, dtype=np.int64)
+        distance_m = np.full(n, np.nan)
+        valid = ~np.isnan(latitude) & ~np.isnan(longitude)
+        if valid.any() and len(self.ends):
+            k = min(k, len(self.ends))
+            position = np.radians(np.c_[latitude[valid], longitude[valid]])
+            angle, candidates = self.tree.query(position, k=k)
+            distance = angle * EARTH_RADIUS_M
+            eligible = np.ones(candidates.shape, dtype=bool)
+            if airports is not None:
+                eligible &= (
+                    self.airport[candidates]
+                    == np.asarray(airports, dtype=object)[valid, None]
+                )
+            # the position has to be within the length of the runway from its end
+            length_m = self.length_ft[candidates] / FT_IN_M
+            eligible &= distance <= length_m + RUNWAY_MAX_OFFSET_M
+            cost = distance
+            if track is not None:
+                track = np.asarray(track, dtype=np.float64)[valid, None]
+                heading = self.heading[candidates]
+                # positions without a track fall back to the nearest end
+                no_track = np.isnan(track)
+                eligible &= no_track | (
+                    angle_difference(heading, track) <= RUNWAY_MAX_HEADING_DIFF
+                )
+                # distance from the centreline through the runway end
+                bearing = initial_bearing(
+                    self.latitude[candidates],
+                    self.longitude[candidates],
+                    latitude[valid, None],
+                    longitude[valid, None],
+                )
+                cross_track = distance * np.abs(np.sin(np.radians(bearing - heading)))
+                eligible &= no_track | (cross_track <= RUNWAY_MAX_OFFSET_M)
+                cost = np.where(no_track, distance, cross_track)
+            cost = np.where(eligible & ~np.isnan(cost), cost, np.inf)
+            best = cost.argmin(axis=1)
+            found = np.isfinite(cost[np.arange(len(best)), best])
+            rows = np.flatnonzero(valid)[found]
+            end[rows] = candidates[found, best[found]]
+            distance_m[rows] = distance[found, best[found]]
+
+        result = self.ends.reindex(end)[
+            ["airport_ident", "ident", "heading", "length_ft", "latitude", "longitude"]
+        ].reset_index(drop=True)
+        result["distance_ft"] = distance_m * FT_IN_M
+        return result
+
+
+@cache
+def runway_index() -> RunwayIndex:
+    # built once per process
+    return RunwayIndex()
+
+
+def angle_difference(a, b) -> np.ndarray:
+    # absolute difference of two angles in degrees, 0..180
+    return np.abs((np.asarray(a) - np.asarray(b) + 180) % 360 - 180)
+
+
+def initial_bearing(lat1, lon1, lat2, lon2) -> np.ndarray:
+    # bearing in degrees from point 1 to point 2
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    y = np.sin(lon2 - lon1) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+    return np.degrees(np.arctan2(y, x)) % 360
+
+
+def distance_ft(a, b) -> float:
+    # great circle distance between two (latitude, longitude) positions
+    return float(haversine_m(a[0], a[1], b[0], b[1])) * FT_IN_M
+
+
+def takeoff_performance(flight, adep: str) -> dict:
+    # takeoff and climb features of one traffic Flight with phase and wind columns, info tells why features are missing
+    # the runway features are added for a whole chunk of flights at once by add_runway_features
+    flight = flight.sort_values("timestamp").filter(altitude=(17, 53)).compute_TAS()
+    try:
+        if not flight.takeoff_from(adep):
+            return {"info": "Wrong airport"}
+        takeoff = next(iter(flight.takeoff(adep)), None)
+    except (ValueError, RuntimeError):
+        return {"info": "Airport not in dataset"}
+    if takeoff is None:
+        return {"info": "No takeoff"}
+
+    data = takeoff.data
+    phases = data["phase"].unique()
+    if "LEVEL" not in phases or "CLIMB" not in phases:
+        return {"info": "Only climb or level phase."}
+
+    acceleration = data[data["phase"] == "LEVEL"]
+    end_of_accel = acceleration.iloc[-1]
+    position = (end_of_accel["latitude"], end_of_accel["longitude"])
+
+    climb = data[data["phase"] == "CLIMB"]
+    altitude_climb_rate = climb["altitude"].diff()
+    last_climb = climb.iloc[-1]
+    last_climb_position = (last_climb["latitude"], last_climb["longitude"])
+
+    return {
+        "adep": adep,
+        "takeoff_latitude": float(position[0]),
+        "takeoff_longitude": float(position[1]),
+        "takeoff_track": float(end_of_accel["track"]),
+        "climb_end_latitude": float(last_climb_position[0]),
+        "climb_end_longitude": float(last_climb_position[1]),
+        "takeoff_TAS": float(end_of_accel["TAS"]),
+        "takeoff_groundspeed": float(end_of_accel["groundspeed"]),
+        "takeoff_cumdist": float(
+            end_of_accel["cumdist"] - acceleration.iloc[0]["cumdist"]
+        ),
+        "climb_mean_climb": climb["vertical_rate"].mean(),
+        "climb_median_climb": climb["vertical_rate"].median(),
+        "climb_max_climb": climb["vertical_rate"].max(),
+        "climb_mean_alt": climb["altitude"].mean(),
+        "climb_median_alt": climb["altitude"].median(),
+        "climb_max_alt": climb["altitude"].max(),
+        "climb_min_tas": climb["TAS"].min(),
+        "climb_mean_tas": climb["TAS"].mean(),
+        "climb_median_tas": climb["TAS"].median(),
+        "climb_max_tas": climb["TAS"].max(),
+        "climb_min_gs": climb["groundspeed"].min(),
+        "climb_mean_gs": climb["groundspeed"].mean(),
+        "climb_median_gs": climb["groundspeed"].median(),
+        "climb_max_gs": climb["groundspeed"].max(),
+        "climb_mean_alt_climb": altitude_climb_rate.mean(),
+        "climb_median_alt_climb": altitude_climb_rate.median(),
+        "climb_max_alt_climb": altitude_climb_rate.max(),
+        "climb_total_altitude_climbed": altitude_climb_rate.sum(),
+        "climb_dist_to_takeoff_point": distance_ft(last_climb_position, position),
+        "info": "OK",
+    }
+
+
+def add_runway_features(frame: pd.DataFrame) -> pd.DataFrame:
+    # runway of the end of the acceleration of all flights with a takeoff in one query, and the runway used from there
+    runways = runway_index().query(
+        frame["takeoff_latitude"].values,
+        frame["takeoff_longitude"].values,
+        frame["takeoff_track"].values,
+        frame["adep"].values,
+    )
+    runway_left = runways["distance_ft"].values
+    runway_used = runways["length_ft"].values - runway_left
+    frame["runway"] = runways["ident"].values
+    frame["runway_heading"] = runways["heading"].values
+    frame["runway_length_ft"] = runways["length_ft"].values
+    frame["runway_ft_left"] = runway_left
+    frame["runway_used"] = runway_used
+    frame["runway_percent_used"] = runway_used / runways["length_ft"].values
+    frame["climb_dist_to_rwy_end"] = (
+        haversine_m(
+            frame["climb_end_latitude"].values,
+            frame["climb_end_longitude"].values,
+            runways["latitude"].values,
+            runways["longitude"].values,
+        )
+        * FT_IN_M
+    )
+    no_runway = (frame["info"] == "OK").values & runways["ident"].isna().values
+    frame.loc[no_runway, "info"] = "No runway"
+    return frame
+
+
+def performance_from_records(records: list) -> pd.DataFrame:
+    # frame with the columns of TAKEOFF_PERFORMANCE_SCHEMA from the per flight dicts of the workers
+    records = [record for record in records if record is not None]
+    frame = pd.DataFrame.from_records(records, columns=RECORD_COLUMNS)
+    float_columns = [
+        c for c in RECORD_COLUMNS if c not in ("flight_id", "adep", "info")
+    ]
+    frame[float_columns] = frame[float_columns].astype(np.float64)
+    frame["flight_id"] = frame["flight_id"].astype(np.int64)
+    frame = add_runway_features(frame)
+    return frame[TAKEOFF_PERFORMANCE_SCHEMA.names]
@@ -2,19 +2,80 @@
 # here i try to do the calculations for each trajecotry once and save the result, because the preprocessing takes a lot of time
 #
 
+import sys
+import argparse
 import pandas as pd
 from pathlib import Path
 from tqdm import tqdm
 import numpy as np
 from multiprocessing import Pool
-from traffic.core import Flight
+from functools import partial
+from threading import Thread
+from queue import Queue
 import warnings
-import re
 import random
+import time
+
+try:
+    from traffic.core import Flight
+except ImportError:
+    # only needed for the traffic engine, the numpy engine runs without it
+    Flight = None
+
+# allow running this file as a script
+sys.path.append(str(Path(__file__).parent.parent.absolute()))
+from preprocessing.trajectory_engine import (
+    ENGINE_VERSION,
+    TAKEOFF_STREAK,
+    LevelSegments,
+    FEATURE_COLUMNS,
+    FEATURE_SCHEMA,
+    COMPLETENESS_FEATURES,
+    WIND_FEATURES,
+    flight_offsets,
+    first_streak_above,
+    lowest_point_before,
+    haversine_m,
+    wind_features_day,
+    create_trajectory_features_day,
+)
+from preprocessing.trajectory_reader import read_flights
+from preprocessing.trajectory_index import indexed_file
+from preprocessing.trajectory_phases import phase_labels
+from preprocessing.trajectory_resampling import decimate
+from preprocessing.trajectory_summary import (
+    completeness_flags,
+    load_summary,
+    summary_file,
+)
+from preprocessing.takeoff_performance import (
+    TAKEOFF_PERFORMANCE_SCHEMA,
+    TAKEOFF_PERFORMANCE_VERSION,
+    performance_from_records,
+    takeoff_performance,
+)
+from preprocessing import fuel_burn
+from preprocessing.fuel_burn import (
+    FUEL_BURN_SCHEMA,
+    FUEL_BURN_VERSION,
+    fuel_burn_features,
+    fuel_burn_from_frames,
+)
+from preprocessing.trajectory_scheduler import WorkerUtilisation, run_unordered
+from preprocessing.trajectory_leases import POLL_S, LeaseQueue
+from preprocessing import trajectory_profiling
+from preprocessing.trajectory_profiling import StageProfile, stage
+from preprocessing.trajectory_feature_store import (
+    TrajectoryFeatureStore,
+    flight_fingerprints,
+    flight_points,
+    flight_list_fingerprint,
+)
 
 #
 # The following functions are used to calculate the trajectory features and generate one single file with the trajectory features
-# The file is saved in the additional_data directory as all_trajectory_features.parquet
+# The features are collected in the incremental feature store (trajectory_feature_store.py) and then saved as
+# additional_data/trajectory_features/all_trajectory_features.parquet
 # The functions are used in the TrajectoryPreprocessor class to add the trajectory features to the dataset, if the file is no available
 #
 
@@ -25,90 +86,537 @@ trajectory_data_dir = root_dir / "data"
 single_flight_data_dir = additional_data_dir / "single_flight_data"
 flight_information_file_1 = trajectory_data_dir / "challenge_set.csv"
 flight_information_file_2 = trajectory_data_dir / "final_submission_set.csv"
+trajectory_data_file = (
+    additional_data_dir / "trajectory_features" / "all_trajectory_features.parquet"
+)
+profile_file = additional_data_dir / "trajectory_features" / "profile.parquet"
+takeoff_performance_file = (
+    additional_data_dir / "trajectory_features" / "takeoff_performance.parquet"
+)
+takeoff_store_dir = additional_data_dir / "trajectory_features" / "takeoff_store"
+fuel_burn_file = additional_data_dir / "trajectory_features" / "fuel_burn.parquet"
+fuel_store_dir = additional_data_dir / "trajectory_features" / "fuel_store"
 
 SPEED_THRESHOLD = 35  # knots
 POOL_NUMBER = 50  # choose 1 for no parallel processing
+PREFETCH_CHUNKS = 8  # chunks of complete flights read ahead while the pool is busy
+CHUNK_POINTS = 200_000  # points per task of the numpy engine
+FEATURE_VERSION = 6  # increase when create_trajectory_features changes, so the store recomputes all flights
+ENGINE_VERSIONS = {"traffic": FEATURE_VERSION, "numpy": ENGINE_VERSION}
 
 flight_information = None
+# compact flight_id -> (adep, ades, aircraft_type) lookup, set once per pool worker by init_worker
+flight_lookup = None
 
 
 def main() -> None:
-    create_trajectory_features_batch()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--stage",
+        choices=["features", "takeoff", "fuel"],
+        default="features",
+        help="features: the trajectory features, takeoff: runway usage and takeoff performance (preprocessing/takeoff_performance.py), "
+        "fuel: fuel burn over the whole trajectory (preprocessing/fuel_burn.py)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["traffic", "numpy"],
+        default="traffic",
+        help="traffic: one traffic.Flight per flight, numpy: vectorized day batches (preprocessing/trajectory_engine.py)",
+    )
+    parser.add_argument(
+        "--skip-merge",
+        action="store_true",
+        help="do not write all_trajectory_features.parquet, the TrajectoryPreprocessor reads the feature store directly",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="record the wall time of every stage and report it per day and for the whole run",
+    )
+    parser.add_argument(
+        "--rerun-failed",
+        action="store_true",
+        help="only compute the flights in the failure table of the feature store",
+    )
+    parser.add_argument(
+        "--resample",
+        type=float,
+        metavar="SECONDS",
+        help="keep one point per SECONDS above 10000 ft (all points below), see preprocessing/trajectory_resampling.py",
+    )
+    parser.add_argument(
+        "--shared",
+        type=Path,
+        help="directory on a shared filesystem, several hosts started with the same directory split the daily files between them",
+    )
+    parser.add_argument(
+        "--node",
+        help="name of this host in the shared directory, defaults to hostname-pid",
+    )
+    args = parser.parse_args()
+    create_trajectory_features_batch(
+        engine=args.engine,
+        pipeline_stage=args.stage,
+        merge=not args.skip_merge,
+        rerun_failed=args.rerun_failed,
+        profile=args.profile,
+        resample=args.resample,
+        shared_dir=args.shared,
+        node=args.node,
+    )
 
 
-def create_trajectory_features_batch() -> None:
+def load_flight_information() -> pd.DataFrame:
+    global flight_information
+    set_1 = pd.read_csv(flight_information_file_1)
+    set_2 = pd.read_csv(flight_information_file_2)
+    flight_information = pd.concat((set_1, set_2))
+    return flight_information
+
+
+def load_flight_lookup() -> dict:
+    return create_flight_lookup(load_flight_information())
+
+
+def create_trajectory_features_batch(
+    engine: str = "traffic",
+    pipeline_stage: str = "features",
+    merge: bool = True,
+    rerun_failed: bool = False,
+    profile: bool = False,
+    resample: float = None,
+    shared_dir: Path = None,
+    node: str = None,
+) -> None:
+    # missing libraries are refused up front, otherwise every flight fails and every day would be recorded as done
+    if pipeline_stage == "fuel":
+        # the fuel stage is vectorized and only needs openap, whatever --engine says
+        if fuel_burn.openap is None:
+            raise ImportError(
+                "The fuel stage needs the openap library, install it to run it."
+            )
+    elif Flight is None and (engine == "traffic" or pipeline_stage == "takeoff"):
+        raise ImportError(
+            "The traffic engine and the takeoff stage need the traffic library, install it or use --engine numpy."
+        )
     try:
-        global flight_information
-        set_1 = pd.read_csv(flight_information_file_1)
-        set_2 = pd.read_csv(flight_information_file_2)
-        flight_information = pd.concat((set_1, set_2))
-
+        lookup = load_flight_lookup()
     except FileNotFoundError:
         print("TrajectoryPreprocessor: Flight information file not found.")
         return
+    # also set it in this process, so create_trajectory_features can be called directly when debugging
+    init_worker(lookup, profile)
+
+    # only flights that are missing in the store, or whose trajectory or feature code changed, are computed
+    # resampled features are stored with their own version, so they never mix with full resolution features
+    suffix = f"-resampled{resample:g}" if resample else ""
+    if pipeline_stage == "takeoff":
+        # the takeoff stage has its own store, it shares the reading, partitioning and the pool with the features
+        if engine != "traffic":
+            print("The takeoff stage needs the traffic engine.")
+            return
+        store = TrajectoryFeatureStore(takeoff_store_dir)
+        version = f"takeoff-{TAKEOFF_PERFORMANCE_VERSION}{suffix}"
+        versions = {version}
+        output_file, output_schema = (
+            takeoff_performance_file,
+            TAKEOFF_PERFORMANCE_SCHEMA,
+        )
+    elif pipeline_stage == "fuel":
+        # vectorized like the numpy engine, whatever --engine says
+        store = TrajectoryFeatureStore(fuel_store_dir)
+        version = f"fuel-{FUEL_BURN_VERSION}{suffix}"
+        versions = {version}
+        output_file, output_schema = fuel_burn_file, FUEL_BURN_SCHEMA
+    else:
+        store = TrajectoryFeatureStore()
+        version = f"{engine}-{ENGINE_VERSIONS[engine]}{suffix}"
+        # one engine per store: the engines define has_takeoff/landing_trajectory differently, so the rows of the other
+        # engine are recomputed instead of mixing both definitions in one training frame
+        versions = {version}
+        output_file, output_schema = trajectory_data_file, FEATURE_SCHEMA
+    flight_list = flight_list_fingerprint(lookup)
+    if shared_dir is not None and pipeline_stage != "features":
+        shared_dir = shared_dir / pipeline_stage
+
+    # with a shared directory every node writes its own store there and claims the days through lease files,
+    # see trajectory_leases.py. The local store only serves to skip what is already computed.
+    base, leases = None, None
+    if shared_dir is not None:
+        leases = LeaseQueue(shared_dir, node)
+        base, store = store, TrajectoryFeatureStore(shared_dir / "nodes" / leases.node)
+        print(f"Running as node {leases.node} on {shared_dir}.")
+    # re-running the failures is meant for a single node
+    sharded = leases is not None and not rerun_failed
+
+    def day_done(date_file: Path) -> bool:
+        if store.day_done(date_file, versions, flight_list):
+            return True
+        if base is None:
+            return False
+        # finished by this host before, or by any node of the shared run
+        return base.day_done(
+            date_file, versions, flight_list
+        ) or TrajectoryFeatureStore.day_state_matches(
+            leases.done_state(date_file.stem), date_file, versions, flight_list
+        )
 
     # split_trajectories_into_single_flights()
-    file_list = list(trajectory_data_dir.glob("*.parquet"))
-    random.shuffle(file_list)
-    for date_file in tqdm(file_list):
-        date = date_file.stem
-        if (additional_data_dir / "trajectory_features" / f"{date}.parquet").exists():
-            print(f"{date} exists, skipping...")
-            continue
-        date_df = pd.read_parquet(date_file)
-        with Pool(POOL_NUMBER) as p:
-            result = p.starmap(
-                create_trajectory_features,
-                [
-                    (
-                        flight_id,
-                        date_df[date_df["flight_id"] == flight_id],
-                        flight_information,
+    flight_ids = lookup
+    if rerun_failed:
+        # only read the days and flights of the failure table
+        failures = store.failures[store.failures["flight_id"].isin(lookup)]
+        print(f"Re-running {len(failures)} failed flights.")
+        flight_ids = set(failures["flight_id"].tolist())
+        todo = [
+            trajectory_data_dir / f"{day}.parquet"
+            for day in sorted(failures["day"].unique())
+            if (trajectory_data_dir / f"{day}.parquet").exists()
+        ]
+    else:
+        if pipeline_stage == "takeoff" and summary_file.exists():
+            # flights that do not start at their departure airport have no takeoff, see trajectory_summary.py
+            flags = completeness_flags(load_summary(), lookup)
+            no_takeoff = set(flags.index[~flags["starts_at_adep"]].tolist())
+            flight_ids = {f for f in lookup if f not in no_takeoff}
+            print(f"Skipping {len(no_takeoff)} flights without takeoff.")
+        file_list = list(trajectory_data_dir.glob("*.parquet"))
+        random.shuffle(file_list)
+        todo = []
+        for date_file in file_list:
+            if day_done(date_file):
+                print(f"{date_file.stem} is complete, skipping...")
+                continue
+            todo.append(date_file)
+
+    if pipeline_stage == "takeoff":
+        partition, worker_function, collect = (
+            partition_by_flight,
+            create_takeoff_features,
+            performance_from_records,
+        )
+    elif pipeline_stage == "fuel":
+        # one enroute call per aircraft type and chunk of flights
+        partition, worker_function, collect = (
+            partition_into_chunks,
+            create_fuel_burn_chunk,
+            fuel_burn_from_frames,
+        )
+    elif engine == "numpy":
+        # the vectorized engine works on chunks of whole flights, one task per chunk
+        partition, worker_function, collect = (
+            partition_into_chunks,
+            create_trajectory_features_chunk,
+            features_from_frames,
+        )
+    else:
+        partition, worker_function, collect = (
+            partition_by_flight,
+            create_trajectory_features,
+            features_from_records,
+        )
+
+    def prepare(date_file: Path, flights: pd.DataFrame) -> tuple:
+        # a flight that crosses midnight is computed for both of its days, see trajectory_feature_store.py
+        with stage("fingerprints", points=len(flights)):
+            fingerprints = flight_fingerprints(flights)
+            stale_mask = store.is_stale(fingerprints, versions, date_file.stem)
+            if base is not None:
+                stale_mask &= base.is_stale(fingerprints, versions, date_file.stem)
+            stale = fingerprints[stale_mask]
+            points = flight_points(flights)[stale.index]
+        flights = flights[flights["flight_id"].isin(stale.index)]
+        if resample:
+            # the fingerprints are of the full trajectories, so a changed point still recomputes the flight
+            with stage("resample", points=len(flights)):
+                flights = decimate(flights, resample)
+        wind = None
+        if engine == "traffic" and pipeline_stage != "fuel":
+            # the traffic engine gets its phases and wind features for the whole chunk at once instead of once per flight
+            with stage("phase_labels", points=len(flights)):
+                flights = flights.assign(phase=phase_labels(flights))
+        if engine == "traffic" and pipeline_stage == "features":
+            with stage("wind_features", points=len(flights)):
+                wind = wind_features_day(flights)
+        with stage("partition", points=len(flights)):
+            tasks = list(partition(flights))
+        # the profiling records of the reader thread travel with the chunk
+        return tasks, stale, points, wind, trajectory_profiling.drain()
+
+    # one pool for the whole run, the lookup is shipped once per worker and the tasks only carry the trajectory slice
+    # the tasks are handed out longest first and collected as they finish, see trajectory_scheduler.py
+    progress = tqdm(total=len(todo))
+    utilisation = WorkerUtilisation(POOL_NUMBER)
+    stage_profile = StageProfile() if profile else None
+    # day -> (flights computed, exceptions of the failed flights) of this run
+    day_outcomes = {}
+    broken_days = set()
+    with Pool(POOL_NUMBER, initializer=init_worker, initargs=(lookup, profile)) as p:
+        pending = todo
+        while pending:
+            date_files = pending
+            if sharded:
+                # the days are claimed one by one as the reader gets to them, days leased by other nodes are left for the next round
+                date_files = leases.claim_each(
+                    pending, key=lambda f: f.stem, done=day_done
+                )
+            stream = prefetch_days(date_files, prepare, flight_ids)
+            for date_file, prepared, results, failures in run_unordered(
+                p, stream, worker_function, utilisation, POOL_NUMBER, stage_profile
+            ):
+                if prepared is None:
+                    # all chunks of the day are done
+                    computed, exceptions = day_outcomes.pop(date_file.stem, (0, set()))
+                    if computed == 0 and len(exceptions) == 1:
+                        # every flight failed the same way, e.g. a missing dependency, the day is not complete
+                        tqdm.write(
+                            f"{date_file.stem}: all flights failed with {exceptions.pop()}, the day is not marked as done."
+                        )
+                        broken_days.add(date_file)
+                        if leases is not None:
+                            leases.release(date_file.stem)
+                        progress.update()
+                        continue
+                    store.mark_day(date_file, version, flight_list)
+                    if leases is not None and date_file.stem in leases.held:
+                        leases.finish(date_file.stem, store.days[date_file.stem])
+                    progress.update()
+                    tqdm.write(f"{date_file.stem}: {utilisation.summary()}")
+                    if profile:
+                        tqdm.write(stage_profile.report(date_file))
+                    continue
+                _, fingerprints, points, wind, records = prepared
+                if profile:
+                    stage_profile.add(date_file, records)
+                result_df = collect(results)
+                if wind is not None:
+                    result_df = add_wind_features(result_df, wind)
+                if len(result_df):
+                    # every chunk is appended right away, so a crash only loses the chunk in flight
+                    store.append(
+                        result_df, fingerprints, points, version, date_file.stem
                     )
-                    for flight_id in date_df["flight_id"].unique()
-                ],
-            )
-            result_df = pd.concat(result, join="outer")
-            result_df.to_parquet(
-                additional_data_dir / "trajectory_features" / f"{date}.parquet",
-                index=False,
-            )
+                # failed flights do not stop the day, they are recorded for --rerun-failed
+                store.record_failures(failures, version, date_file.stem)
+                computed, exceptions = day_outcomes.get(date_file.stem, (0, set()))
+                day_outcomes[date_file.stem] = (
+                    computed + len(result_df),
+                    exceptions | {failure["exception"] for failure in failures},
+                )
+            if not sharded:
+                break
+            # wait for the days of the other nodes, the day of a crashed node is taken over once its lease expired
+            pending = [
+                date_file
+                for date_file in pending
+                if not day_done(date_file) and date_file not in broken_days
+            ]
+            if pending:
+                tqdm.write(f"{len(pending)} days leased by other nodes, waiting...")
+                time.sleep(POLL_S)
+
+    # only the node that merged the shared stores writes the merged file, it holds the merge lease until then
+    merged = True
+    if leases is not None:
+        store, merged = merge_shared_stores(base, store, shared_dir, leases)
+
+    print(utilisation.table().to_string())
+    print(utilisation.summary())
+    if profile:
+        print(stage_profile.report())
+        profile_file.parent.mkdir(parents=True, exist_ok=True)
+        stage_profile.frame().to_parquet(profile_file, index=False)
+        print(f"Profiling records written to {profile_file}.")
+    print(f"{len(store)} flights in the trajectory feature store.")
+    if len(store.failures):
+        print(
+            f"{len(store.failures)} flights failed, see {store.failures_file} "
+            "and re-run them with --rerun-failed:"
+        )
+        print(store.failures.value_counts("stage").to_string())
+    try:
+        if merge and not merged:
+            print(f"The node merging the shared stores writes {output_file}.")
+        elif merge:
+            # combine the store into one file, streamed part by part
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            rows = store.write_merged(output_file, output_schema)
+            print(f"Wrote {rows} flights to {output_file}.")
+    finally:
+        if leases is not None:
+            if merged:
+                leases.release("merge")
+            leases.stop()
+
+
+def merge_shared_stores(
+    base: TrajectoryFeatureStore,
+    store: TrajectoryFeatureStore,
+    shared_dir: Path,
+    leases: LeaseQueue,
+) -> tuple:
+    # the node that gets the merge lease merges the stores of all nodes into the local store, the others only report their own
+    # returns (store, True) with the merge lease still held by this node, the caller releases it after writing the merged file
+    # merging is idempotent, so a node that finishes later can simply run again (all its days are done) to merge again
+    if not leases.claim("merge"):
+        print("Another node is merging the shared stores.")
+        return store, False
+    try:
+        for node_dir in sorted((shared_dir / "nodes").iterdir()):
+            if node_dir.is_dir():
+                flights = base.merge_from(TrajectoryFeatureStore(node_dir))
+                print(f"Merged {flights} flights of node {node_dir.name}.")
+    except BaseException:
+        leases.release("merge")
+        raise
+    return base, True
+
+
+def prefetch_days(
+    date_files: list, prepare, flight_ids=None, prefetch: int = PREFETCH_CHUNKS
+):
+    # stream and prepare the next chunks of complete flights in a background thread while the pool works on the current one
+    # yields (date_file, prepare(date_file, flights)) for every chunk and (date_file, None) once all chunks of a day have been yielded
+    # with flight_ids, all other flights are dropped while reading, so they are never partitioned or dispatched
+    queue = Queue(maxsize=max(prefetch, 1))
+
+    def reader() -> None:
+        try:
+            for date_file in date_files:
+                # the indexed file of the day (trajectory_index.py) if it is up to date
+                for flights in read_flights(indexed_file(date_file), flight_ids):
+                    queue.put((date_file, prepare(date_file, flights)))
+                queue.put((date_file, None))
+        except Exception as e:
+            # hand the error over to the consuming thread
+            queue.put(e)
+        queue.put(None)
+
+    Thread(target=reader, daemon=True).start()
+    while (item := queue.get()) is not None:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def create_flight_lookup(flight_information: pd.DataFrame) -> dict:
+    # flight_id -> (adep, ades, aircraft_type), a few MB instead of the full challenge/submission frames
+    flight_information = flight_information.drop_duplicates("flight_id")
+    return dict(
+        zip(
+            flight_information["flight_id"].tolist(),
+            zip(
+                flight_information["adep"].tolist(),
+                flight_information["ades"].tolist(),
+                flight_information["aircraft_type"].tolist(),
+            ),
+        )
+    )
 
-        # result_df = pd.concat([create_trajectory_features(flight_id, date_df[date_df["flight_id"] == flight_id]) for flight_id in date_df["flight_id"].unique()], axis=1)
-        # result_df.to_parquet(additional_data_dir / "trajectory_features" / f"{date}.parquet", index=False)
 
-    # combine all the parquet files into one
-    # Define the regex pattern for yyyy-mm-dd.parquet
-    pattern = re.compile(r"\d{4}-\d{2}-\d{2}\.parquet")
+def init_worker(lookup: dict, profile: bool = False) -> None:
+    # pool initializer, runs once per worker process
+    global flight_lookup
+    flight_lookup = lookup
+    trajectory_profiling.enable(profile)
 
-    # Use the pattern to filter the files
-    all_files = [
-        file
-        for file in additional_data_dir.glob("trajectory_features/*.parquet")
-        if pattern.match(file.name)
-    ]
-    all_data = pd.concat([pd.read_parquet(file) for file in all_files])
-    all_data.to_parquet(
-        additional_data_dir / "all_trajectory_features.parquet", index=False
-    )
 
+def partition_by_flight(date_df: pd.DataFrame):
+    # sort the day once by flight_id and hand out contiguous slices, instead of scanning the whole day with a boolean mask for every flight
+    # the sort is stable, so the points of a flight keep their original order
+    date_df = date_df.sort_values("flight_id", kind="stable", ignore_index=True)
+    flight_ids, starts, ends = flight_offsets(date_df["flight_id"].values)
+    for flight_id, start, end in zip(flight_ids, starts, ends):
+        # every slice gets a fresh RangeIndex, as the climb/acceleration helpers below mix index labels and positions
+        yield flight_id, date_df.iloc[start:end].reset_index(drop=True)
 
-def create_trajectory_features(
-    flight_id, trajectory, flight_information
-) -> pd.DataFrame:
-    if flight_id not in flight_information["flight_id"].values:
-        # print(f"Flight {flight_id} not found in challenge set.")
-        return pd.DataFrame()
-    flight = Flight(trajectory)
 
-    try:
-        flight = flight.phases(twindow=60)
-    except ValueError:
-        flight.data["phase"] = "NA"
+def partition_into_chunks(date_df: pd.DataFrame, chunk_points: int = CHUNK_POINTS):
+    # cut the sorted day into chunks of whole flights with roughly chunk_points points
+    if len(date_df) == 0:
+        return
+    date_df = date_df.sort_values("flight_id", kind="stable", ignore_index=True)
+    n_chunks = max(1, int(np.ceil(len(date_df) / chunk_points)))
+    _, starts, _ = flight_offsets(date_df["flight_id"].values)
+    targets = np.linspace(0, len(date_df), n_chunks + 1)[1:-1]
+    # snap every target row to the start of the flight it falls into
+    cuts = np.unique(starts[np.searchsorted(starts, targets, side="right") - 1])
+    bounds = np.r_[0, cuts[cuts > 0], len(date_df)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        yield (date_df.iloc[start:end],)
+
+
+def features_from_records(records: list) -> pd.DataFrame:
+    # build the feature frame with the fixed schema in one go from the per flight dicts of the workers
+    # features that a flight does not have (e.g. no cruise) are NaN
+    records = [record for record in records if record is not None]
+    n = len(records)
+    columns = {}
+    for column in FEATURE_COLUMNS:
+        if column == "flight_id":
+            values = (record[column] for record in records)
+            columns[column] = np.fromiter(values, dtype=np.int64, count=n)
+        elif column in COMPLETENESS_FEATURES:
+            # has_takeoff/landing_trajectory is None when the airport check fails
+            values = (bool(record.get(column)) for record in records)
+            columns[column] = np.fromiter(values, dtype=bool, count=n)
+        else:
+            values = (record.get(column, np.nan) for record in records)
+            columns[column] = np.fromiter(values, dtype=np.float64, count=n)
+    return pd.DataFrame(columns)
+
+
+def add_wind_features(features: pd.DataFrame, wind: pd.DataFrame) -> pd.DataFrame:
+    # fill in the wind features computed by wind_features_day for the flights with a cruise phase
+    # like the per flight version, flights without any level flight point get -1, flights whose level flight points
+    # have no wind get NaN
+    wind = wind.reindex(features["flight_id"].values)
+    wind.loc[wind["level_points"].values == 0, WIND_FEATURES] = -1
+    has_cruise = features["has_cruise_trajectory"].values
+    for column in WIND_FEATURES:
+        features[column] = np.where(has_cruise, wind[column].values, np.nan)
+    return features
+
+
+def features_from_frames(frames: list) -> pd.DataFrame:
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return features_from_records([])
+    return pd.concat(frames, ignore_index=True)
+
+
+def create_trajectory_features_chunk(trajectories: pd.DataFrame) -> pd.DataFrame:
+    return create_trajectory_features_day(trajectories, flight_lookup)
+
+
+def create_fuel_burn_chunk(trajectories: pd.DataFrame) -> pd.DataFrame:
+    # worker function of the fuel stage, the FuelFlow models stay cached in the worker between chunks
+    return fuel_burn_features(trajectories, flight_lookup)
+
+
+def create_trajectory_features(flight_id, trajectory) -> dict:
+    # unknown flights are already dropped while reading, this only guards direct calls
+    if flight_id not in flight_lookup:
+        # print(f"Flight {flight_id} not found in challenge set.")
+        return None
+    # stages of the --profile report
+    profiled = partial(stage, flight_id=flight_id, points=len(trajectory))
+    with profiled("flight"):
+        flight = Flight(trajectory)
+
+    if "phase" not in flight.data:
+        # the batch job labels the phases of the whole chunk at once, see trajectory_phases.py
+        with profiled("phases"):
+            try:
+                flight = flight.phases(twindow=60)
+            except ValueError:
+                flight.data["phase"] = "NA"
         # with warnings.catch_warnings(action="ignore"):
         #     flight.data["phase"] = "NA"
 
-    flight = flight.cumulative_distance()
+    with profiled("cumulative_distance"):
+        flight = flight.cumulative_distance()
 
     # TODO: RuntimeError: No wind data in trajectory. Consider Flight.include_grib()
     # flight = flight.compute_TAS()
@@ -122,13 +630,12 @@ def create_trajectory_features(
     result["track_distance_m"] = track_distance_m
 
     # not all trajectories are complete, so we check if the trajectory has a takeoff, landing and cruise phase
-    result["has_takeoff_trajectory"] = has_takeoff_trajectory(
-        flight, flight_information
-    )
-    result["has_landing_trajectory"] = has_landing_trajectory(
-        flight, flight_information
-    )
-    result["has_cruise_trajectory"] = has_cruise_trajectory(flight)
+    with profiled("takeoff_from"):
+        result["has_takeoff_trajectory"] = has_takeoff_trajectory(flight, flight_lookup)
+    with profiled("landing_at"):
+        result["has_landing_trajectory"] = has_landing_trajectory(flight, flight_lookup)
+    with profiled("has_cruise"):
+        result["has_cruise_trajectory"] = has_cruise_trajectory(flight)
 
     # TODO: we should not do this here, as it is not part of the trajectory features, and the weight is not available in the challenge set
     #
@@ -136,18 +643,20 @@ def create_trajectory_features(
     # result["fuel_burnt_kg"] = flight.data["fuel"].iloc[-1]
 
     if result["has_takeoff_trajectory"]:
-        result.update(calculate_takeoff_features(flight))
+        with profiled("takeoff_features"):
+            result.update(calculate_takeoff_features(flight))
 
     if result["has_cruise_trajectory"]:
-        result.update(get_cruise_data(flight))
-        result.update(get_wind_data_level_flight(flight))
+        with profiled("cruise_features"):
+            result.update(get_cruise_data(flight))
+        # the wind features are added for the whole chunk at once, see add_wind_features
 
     else:
         # use negative values for the features if the takeoff trajectory is not complete
         result["taxi_out_time_s"] = -1
         result["takeoff_mean_acceleration"] = -1
         result["takeoff_max_acceleration"] = -1
-        # result["takeoff_roll_distance_m"] = -1
+        result["takeoff_roll_distance_m"] = -1
         result["v2_speed_kt"] = -1
         result["initclimb_mean_climb"] = -1
         result["initclimb_median_climb"] = -1
@@ -164,7 +673,33 @@ def create_trajectory_features(
         result["initclimb_median_gs"] = -1
         result["initclimb_max_gs"] = -1
 
-    return pd.DataFrame([result])
+    # a plain dict is cheap to pickle, features_from_records builds the frame for all flights at once
+    return result
+
+
+def create_takeoff_features(flight_id, trajectory) -> dict:
+    # worker function of the takeoff stage
+    if flight_id not in flight_lookup:
+        return None
+    adep, _, _ = flight_lookup[flight_id]
+    profiled = partial(stage, flight_id=flight_id, points=len(trajectory))
+    with profiled("flight"):
+        # compute_TAS expects the wind as wind_u/wind_v
+        flight = Flight(
+            trajectory.rename(
+                columns={
+                    "u_component_of_wind": "wind_u",
+                    "v_component_of_wind": "wind_v",
+                }
+            )
+        )
+    if "phase" not in flight.data:
+        with profiled("phases"):
+            flight = flight.phases(twindow=60)
+    with profiled("takeoff_performance"):
+        result = takeoff_performance(flight, adep)
+    result["flight_id"] = flight_id
+    return result
 
 
 def calculate_takeoff_features(flight: Flight) -> dict:
@@ -178,8 +713,8 @@ def calculate_takeoff_features(flight: Flight) -> dict:
     result["takeoff_mean_acceleration"] = acceleration.mean()
     result["takeoff_max_acceleration"] = acceleration.max()
 
-    # takeoff_roll_distance_m = calculate_takeoff_roll_distance_m(climb)
-    # result["takeoff_roll_distance_m"] = takeoff_roll_distance_m
+    takeoff_roll_distance_m = calculate_takeoff_roll_distance_m(climb)
+    result["takeoff_roll_distance_m"] = takeoff_roll_distance_m
 
     v2_speed = get_v2_speed(climb)
     result["v2_speed_kt"] = v2_speed
@@ -202,11 +737,8 @@ def calculate_takeoff_features(flight: Flight) -> dict:
     return result
 
 
-def has_takeoff_trajectory(flight: Flight, flight_information: pd.DataFrame) -> bool:
-    flight_id = flight.flight_id
-    adep = flight_information[flight_information["flight_id"] == flight_id][
-        "adep"
-    ].values[0]
+def has_takeoff_trajectory(flight: Flight, flight_lookup: dict) -> bool:
+    adep, _, _ = flight_lookup[flight.flight_id]
     try:
         if flight.takeoff_from(adep):
             # check if there is a climb phase within the first hour of the flight
@@ -216,12 +748,8 @@ def has_takeoff_trajectory(flight: Flight, flight_information: pd.DataFrame) ->
         return False
 
 
-def has_landing_trajectory(flight: Flight, flight_information: pd.DataFrame) -> bool:
-    flight_id = flight.flight_id
-    ades = flight_information[flight_information["flight_id"] == flight_id][
-        "ades"
-    ].values[0]
-
+def has_landing_trajectory(flight: Flight, flight_lookup: dict) -> bool:
+    _, ades, _ = flight_lookup[flight.flight_id]
     try:
         if flight.landing_at(ades):
             # check if there is a descent phase within the last hour of the flight
@@ -260,11 +788,10 @@ def get_initial_climb_trajectory(flight: Flight) -> pd.DataFrame:
             climbs.index.to_series().diff().ne(1).iloc[1:].idxmax()
         )
         climb_trajectory = flight.data[:last_index_of_first_climb]
-    except ValueError:
-        print(f"Flight {flight.flight_id} has no climb phase.")
-        print(flight.data)
-        print(flight.data.value_counts("phase"))
-        raise ValueError
+    except ValueError as e:
+        # recorded in the failure table of the feature store by the scheduler
+        phases = flight.data.value_counts("phase").to_dict()
+        raise ValueError(f"no climb phase, phases: {phases}") from e
 
     # Old code from the original preprocessing script, obsolete with the traffic library
     # simple function to get the initial climb trajectory of the aircraft until it reaches an altitude of 5000 ft
@@ -333,55 +860,32 @@ def calculate_taxi_out_time(trajectory: pd.DataFrame) -> float:
 def calculate_takeoff_roll_distance_m(trajectory: pd.DataFrame) -> float:
     # look at the first time speed is above 35 knots,
     first_index_above_35knots = find_first_index_with_streak_above(
-        trajectory, "groundspeed", SPEED_THRESHOLD, count=5
+        trajectory, "groundspeed", SPEED_THRESHOLD, count=TAKEOFF_STREAK
     )
     # from there, go back to the lowest previous speed before it rises again to set the point where the takeoff roll starts
-    takeoff_roll_start = first_index_above_35knots
-    # iterate back to find the lowest speed before the speed increases again, or as far as 20 ticks before the first index above 35 knots
-    for i in range(
-        first_index_above_35knots,
-        max(trajectory.index.argmin(), first_index_above_35knots - 20),
-        -1,
-    ):
-        try:
-            if (
-                trajectory.loc[i, "groundspeed"]
-                < trajectory.loc[takeoff_roll_start, "groundspeed"]
-            ):
-                takeoff_roll_start = i
-            if (
-                trajectory.loc[i, "groundspeed"]
-                > trajectory.loc[takeoff_roll_start, "groundspeed"]
-            ):
-                # speed increases further back, so we break the loop
-                break
-        except KeyError:
-            # there is a break in the trajectory, so we keep the last index
-            break
+    # (at most 20 ticks before the first index above 35 knots), vectorized in lowest_point_before
+    takeoff_roll_start = lowest_point_before(
+        trajectory["groundspeed"].to_numpy(dtype=np.float64, na_value=np.nan),
+        np.array([0]),
+        np.array([first_index_above_35knots]),
+    )[0]
 
     # takeoff roll ends when vertical speed is positive
-    takeoff_roll_end = trajectory[trajectory["vertical_rate"] > 200].index[0]
-
-    if takeoff_roll_end <= takeoff_roll_start:
+    climbing = np.flatnonzero(trajectory["vertical_rate"].to_numpy() > 200)
+    if len(climbing) == 0 or climbing[0] <= takeoff_roll_start:
         # if the data is not accurate enough, we return -1
         return -1
+    takeoff_roll_end = climbing[0]
 
     # calculate haversine distance between the two points
-    lat1 = np.radians(trajectory.loc[takeoff_roll_start, "latitude"])
-    lon1 = np.radians(trajectory.loc[takeoff_roll_start, "longitude"])
-    lat2 = np.radians(trajectory.loc[takeoff_roll_end, "latitude"])
-    lon2 = np.radians(trajectory.loc[takeoff_roll_end, "longitude"])
-
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-
-    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arcsin(np.sqrt(a))
-
-    R = 6371000  # radius of the earth in meters
-    distance = R * c
-
-    return distance
+    latitude = trajectory["latitude"].to_numpy()
+    longitude = trajectory["longitude"].to_numpy()
+    return haversine_m(
+        latitude[takeoff_roll_start],
+        longitude[takeoff_roll_start],
+        latitude[takeoff_roll_end],
+        longitude[takeoff_roll_end],
+    )
 
 
 def get_v2_speed(trajectory: pd.DataFrame) -> float:
@@ -398,19 +902,18 @@ def get_v2_speed(trajectory: pd.DataFrame) -> float:
 
 def get_cruise_data(flight: Flight) -> dict:
     # get the longest level flight segment and the altitude of the aircraft during this segment with mean cruise speed
-    # begin_of_phase = flight["phase"].ne(flight["phase"].shift())
-    # segments_ids = begin_of_phase.cumsum()
-
-    cruise_altitude = flight.data["altitude"].value_counts().idxmax()
-
-    # TODO use pandas.mode() instead of manually counting the values
-
-    # Idea: iterate through the flight and find the longest consecutive streak of the cruise altitude to get the longest cruise phase for altitude and speed calculation
-    #
-
-    cruise_altitude = flight.data["altitude"].mode()[0]
-    flight_at_cruise_altitude = flight.data[flight.data["altitude"] == cruise_altitude]
+    # level segments are runs of consecutive points within the same altitude band (run-length encoding, see LevelSegments)
+    data = flight.data
+    seconds = (data["timestamp"] - data["timestamp"].iloc[0]).dt.total_seconds()
+    segments = LevelSegments(
+        data["altitude"].to_numpy(dtype=np.float64),
+        seconds.to_numpy(dtype=np.float64),
+        np.zeros(len(data), dtype=np.int64),
+        1,
+    )
+    flight_at_cruise_altitude = data[segments.point_mask(segments.cruise())]
 
+    cruise_altitude = flight_at_cruise_altitude["altitude"].median()
     mean_cruise_speed = flight_at_cruise_altitude["groundspeed"].mean()
     median_cruise_speed = flight_at_cruise_altitude["groundspeed"].median()
     lowest_cruise_speed = flight_at_cruise_altitude["groundspeed"].min()
@@ -427,53 +930,13 @@ def get_cruise_data(flight: Flight) -> dict:
     }
 
 
-def get_wind_data_level_flight(flight: Flight) -> dict:
-    # filter level cruise phase
-    flight = flight.query("15000 < altitude < 40000")
-
-    if flight is None:
-        return {
-            "average_headwind": -1,
-            "max_headwind": -1,
-            "min_headwind": -1,
-            "std_headwind": -1,
-        }
-    track_rad = np.radians(flight.data["track"])
-    wind_speed = np.sqrt(
-        flight.data["u_component_of_wind"] ** 2
-        + flight.data["v_component_of_wind"] ** 2
-    )
-    wind_direction = np.arctan2(
-        flight.data["u_component_of_wind"], flight.data["v_component_of_wind"]
-    )
-
-    # Calculate headwind component
-    # Positive values indicate headwind, negative values indicate tailwind
-    headwind = wind_speed * np.cos(wind_direction - track_rad)
-
-    result = {
-        "average_headwind": headwind.mean(),
-        "max_headwind": headwind.max(),
-        "min_headwind": headwind.min(),
-        "std_headwind": headwind.std(),
-    }
-
-    return result
-
-
 def find_first_index_with_streak_above(data, column, value, count=10) -> int:
     # this function returns the first index, where a streak begins with at least count values above the given value, or last index if no such streak is found
-    streak = 0
-    for i, row in data.iterrows():
-        if row[column] > value:
-            streak += 1
-            if streak >= count:
-                # streak of at least count values above the threshold
-                # return the index where the streak started
-                return i - count + 1
-        else:
-            streak = 0
-    return len(data) - 1
+    values = data[column].to_numpy(dtype=np.float64, na_value=np.nan)
+    start = first_streak_above(
+        values, np.zeros(len(values), dtype=np.int64), 1, value, count
+    )[0]
+    return int(start) if start >= 0 else len(data) - 1
 
 
 def has_diverted(flight: Flight) -> bool:
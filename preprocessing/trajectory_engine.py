@@ -0,0 +1,754 @@
+#
+# Vectorized version of the trajectory features in trajectory_batchprocessing.py
+# All flights of a day are kept in contiguous numpy arrays (sorted by flight_id) and the features are computed with segment reductions,
+# so there is no traffic.Flight per flight and the engine runs in the main environment without the traffic library.
+#
+# Usage (computes one day and compares it with the features of the traffic based batch job, if they exist):
+#   python ./preprocessing/trajectory_engine.py data/2022-01-01.parquet
+#
+
+import sys
+import time
+from functools import cache, cached_property
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+root_dir = Path(__file__).parent.parent.absolute()
+# allow running this file as a script
+sys.path.append(str(root_dir))
+from preprocessing.trajectory_phases import (
+    CLIMB,
+    DESCENT,
+    label_phases as label_phases_points,
+)
+from preprocessing.trajectory_profiling import stage
+
+additional_data_dir = root_dir / "additional_data"
+
+# increase when the features change, so the feature store recomputes all flights
+ENGINE_VERSION = 5
+SPEED_THRESHOLD = 35  # knots, same as in trajectory_batchprocessing.py
+TAKEOFF_STREAK = 5  # points above SPEED_THRESHOLD in a row that start the takeoff roll
+TAKEOFF_ROLL_LOOKBACK = 20  # points to go back from there to find the lowest speed
+LEVEL_BAND_FT = 500  # altitudes are rounded to this band, consecutive points in the same band form a level segment
+CRUISE_MIN_ALTITUDE_FT = 15000  # level segments below are not considered as cruise
+AIRPORT_RADIUS_KM = (
+    10  # first/last point has to be this close to adep/ades to count as takeoff/landing
+)
+AIRPORT_MAX_HEIGHT_FT = 3000  # and this low above the airport elevation
+EARTH_RADIUS_M = 6371000
+NM_IN_M = 1852
+
+TAKEOFF_FEATURES = [
+    "taxi_out_time_s",
+    "takeoff_mean_acceleration",
+    "takeoff_max_acceleration",
+    "takeoff_roll_distance_m",
+    "v2_speed_kt",
+    "initclimb_mean_climb",
+    "initclimb_median_climb",
+    "initclimb_max_climb",
+    "initclimb_mean_alt",
+    "initclimb_median_alt",
+    "initclimb_max_alt",
+    "initclimb_min_gs",
+    "initclimb_mean_gs",
+    "initclimb_median_gs",
+    "initclimb_max_gs",
+]
+CRUISE_FEATURES = [
+    "cruise_altitude",
+    "mean_cruise_speed",
+    "median_cruise_speed",
+    "lowest_cruise_speed",
+    "highest_cruise_speed",
+    "cruise_speed_std",
+]
+WIND_FEATURES = ["average_headwind", "max_headwind", "min_headwind", "std_headwind"]
+COMPLETENESS_FEATURES = [
+    "has_takeoff_trajectory",
+    "has_landing_trajectory",
+    "has_cruise_trajectory",
+]
+# fixed schema of the feature files, all other columns are float64
+FEATURE_COLUMNS = [
+    "flight_id",
+    "track_distance_m",
+    *COMPLETENESS_FEATURES,
+    *TAKEOFF_FEATURES,
+    *CRUISE_FEATURES,
+    *WIND_FEATURES,
+]
+FEATURE_SCHEMA = pa.schema(
+    [("flight_id", pa.int64())]
+    + [
+        (column, pa.bool_() if column in COMPLETENESS_FEATURES else pa.float64())
+        for column in FEATURE_COLUMNS[1:]
+    ]
+)
+
+
+def flight_offsets(flight_ids: np.ndarray) -> tuple:
+    # offset table for an array that is already sorted by flight_id:
+    # returns the unique flight_ids and the start/end row of each flight
+    if len(flight_ids) == 0:
+        empty = np.array([], dtype=np.int64)
+        return flight_ids[:0], empty, empty
+    starts = np.flatnonzero(np.r_[True, flight_ids[1:] != flight_ids[:-1]])
+    ends = np.r_[starts[1:], len(flight_ids)]
+    return flight_ids[starts], starts, ends
+
+
+class FlightBatch:
+    # all points of many flights as contiguous numpy arrays, sorted by flight_id
+    # group[i] is the flight number (0..n_flights-1) of point i, position[i] the index of the point within its flight
+
+    def __init__(self, trajectories: pd.DataFrame) -> None:
+        trajectories = trajectories.sort_values(
+            "flight_id", kind="stable", ignore_index=True
+        )
+        self.flight_ids, self.starts, self.ends = flight_offsets(
+            trajectories["flight_id"].values
+        )
+        self.counts = self.ends - self.starts
+        self.n_flights = len(self.flight_ids)
+        self.group = np.repeat(np.arange(self.n_flights), self.counts)
+        self.position = np.arange(len(trajectories)) - np.repeat(
+            self.starts, self.counts
+        )
+
+        timestamps = trajectories["timestamp"].values.astype("datetime64[ns]")
+        self.time = timestamps.astype(np.int64) / 1e9  # seconds
+        self.latitude = self.column(trajectories, "latitude")
+        self.longitude = self.column(trajectories, "longitude")
+        self.altitude = self.column(trajectories, "altitude")
+        self.groundspeed = self.column(trajectories, "groundspeed")
+        self.track = self.column(trajectories, "track")
+        self.vertical_rate = self.column(trajectories, "vertical_rate")
+        self.u_wind = self.column(trajectories, "u_component_of_wind")
+        self.v_wind = self.column(trajectories, "v_component_of_wind")
+
+        # True where the previous point belongs to the same flight
+        self.has_previous = self.position > 0
+
+    @staticmethod
+    def column(trajectories: pd.DataFrame, name: str) -> np.ndarray:
+        if name not in trajectories:
+            return np.full(len(trajectories), np.nan)
+        return trajectories[name].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    def __len__(self) -> int:
+        return self.n_flights
+
+    def previous(self, values: np.ndarray) -> np.ndarray:
+        # value of the previous point of the same flight, NaN for the first point of a flight
+        shifted = np.r_[np.nan, values[:-1]]
+        shifted[~self.has_previous] = np.nan
+        return shifted
+
+    def per_point(self, values: np.ndarray) -> np.ndarray:
+        # broadcast one value per flight to all points of the flight
+        return values[self.group]
+
+    @cached_property
+    def level_segments(self) -> "LevelSegments":
+        # computed once per batch and shared by the cruise, wind and fuel flow features
+        return LevelSegments(self.altitude, self.time, self.group, self.n_flights)
+
+
+class LevelSegments:
+    # run-length encoding of the banded altitude: runs of consecutive points of a flight within the same LEVEL_BAND_FT band
+    # start/end (exclusive) are point indices, group the flight of the segment
+
+    def __init__(self, altitude, time, group, n_groups, band_ft=LEVEL_BAND_FT) -> None:
+        self.n_points = len(altitude)
+        self.n_groups = n_groups
+        band = np.round(altitude / band_ft)
+        # NaN != NaN, so every point without altitude is a segment of its own
+        self.start = np.flatnonzero(
+            np.r_[
+                self.n_points > 0, (group[1:] != group[:-1]) | (band[1:] != band[:-1])
+            ]
+        )
+        self.end = np.r_[self.start[1:], self.n_points].astype(np.int64)
+        self.group = group[self.start]
+        self.altitude = band[self.start] * band_ft
+        self.duration = time[self.end - 1] - time[self.start]
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def longest(self, min_altitude=CRUISE_MIN_ALTITUDE_FT) -> np.ndarray:
+        # index of the longest (in time) segment above min_altitude of every flight, the first one on ties, -1 if there is none
+        eligible = self.altitude > min_altitude
+        longest = segment_max(self.duration, self.group, self.n_groups, eligible)
+        is_longest = eligible & (self.duration == longest[self.group])
+        return segment_first(is_longest, self.group, self.n_groups)
+
+    def cruise(self) -> np.ndarray:
+        # the longest segment above CRUISE_MIN_ALTITUDE_FT, for short flights that stay below the longest segment at all
+        cruise = self.longest()
+        return np.where(cruise >= 0, cruise, self.longest(-np.inf))
+
+    def point_mask(self, segments: np.ndarray) -> np.ndarray:
+        # per point mask of the given segments (-1 entries are ignored)
+        segments = segments[segments >= 0]
+        change = np.zeros(self.n_points + 1, dtype=np.int64)
+        np.add.at(change, self.start[segments], 1)
+        np.add.at(change, self.end[segments], -1)
+        return np.cumsum(change[:-1]) > 0
+
+
+#
+# Segment reductions over the flights of a batch
+# All of them ignore NaN values (like pandas) and return NaN for flights without any (masked) values
+#
+
+
+def _select(values, group, mask):
+    keep = ~np.isnan(values)
+    if mask is not None:
+        keep &= mask
+    return values[keep], group[keep]
+
+
+def _reduce(ufunc, values, group, n_groups) -> np.ndarray:
+    # group is sorted, so every group is one contiguous run for reduceat
+    out = np.full(n_groups, np.nan)
+    if len(values) == 0:
+        return out
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    out[group[starts]] = ufunc.reduceat(values, starts)
+    return out
+
+
+def segment_count(values, group, n_groups, mask=None) -> np.ndarray:
+    values, group = _select(values, group, mask)
+    return np.bincount(group, minlength=n_groups)
+
+
+def segment_sum(values, group, n_groups, mask=None) -> np.ndarray:
+    values, group = _select(values, group, mask)
+    return np.bincount(group, weights=values, minlength=n_groups)
+
+
+def segment_mean(values, group, n_groups, mask=None) -> np.ndarray:
+    values, group = _select(values, group, mask)
+    count = np.bincount(group, minlength=n_groups)
+    total = np.bincount(group, weights=values, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def segment_min(values, group, n_groups, mask=None) -> np.ndarray:
+    return _reduce(np.minimum, *_select(values, group, mask), n_groups)
+
+
+def segment_max(values, group, n_groups, mask=None) -> np.ndarray:
+    return _reduce(np.maximum, *_select(values, group, mask), n_groups)
+
+
+def segment_std(values, group, n_groups, mask=None) -> np.ndarray:
+    # sample standard deviation (ddof=1), like pandas
+    values, group = _select(values, group, mask)
+    count = np.bincount(group, minlength=n_groups)
+    mean = np.bincount(group, weights=values, minlength=n_groups) / np.maximum(count, 1)
+    squared = np.bincount(
+        group, weights=(values - mean[group]) ** 2, minlength=n_groups
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 1, np.sqrt(squared / (count - 1)), np.nan)
+
+
+def segment_median(values, group, n_groups, mask=None) -> np.ndarray:
+    values, group = _select(values, group, mask)
+    order = np.lexsort((values, group))
+    values = values[order]
+    count = np.bincount(group, minlength=n_groups)
+    first = np.r_[0, np.cumsum(count)[:-1]]
+    out = np.full(n_groups, np.nan)
+    has_values = count > 0
+    lower = (first + (count - 1) // 2)[has_values]
+    upper = (first + count // 2)[has_values]
+    out[has_values] = (values[lower] + values[upper]) / 2
+    return out
+
+
+def segment_first(mask, group, n_groups) -> np.ndarray:
+    # index (into the point arrays) of the first True point of every group, -1 if there is none
+    out = np.full(n_groups, -1, dtype=np.int64)
+    index = np.flatnonzero(mask)
+    if len(index) == 0:
+        return out
+    first = np.r_[True, group[index][1:] != group[index][:-1]]
+    out[group[index[first]]] = index[first]
+    return out
+
+
+def segment_last(mask, group, n_groups) -> np.ndarray:
+    # index (into the point arrays) of the last True point of every group, -1 if there is none
+    out = np.full(n_groups, -1, dtype=np.int64)
+    index = np.flatnonzero(mask)
+    if len(index) == 0:
+        return out
+    last = np.r_[group[index][1:] != group[index][:-1], True]
+    out[group[index[last]]] = index[last]
+    return out
+
+
+def take(values: np.ndarray, index: np.ndarray, fill=np.nan) -> np.ndarray:
+    # values[index] with fill where index is -1
+    out = np.full(len(index), fill, dtype=np.float64)
+    valid = index >= 0
+    out[valid] = values[index[valid]]
+    return out
+
+
+def first_streak_above(
+    values, group, n_groups, threshold, count, mask=None
+) -> np.ndarray:
+    # index of the first point of the first run of at least count consecutive values above threshold in every group, -1 if there is none
+    # points outside of mask break a run, group has to be sorted
+    above = values > threshold
+    if mask is not None:
+        above &= mask
+    if len(above) == 0:
+        return np.full(n_groups, -1, dtype=np.int64)
+    run_start = np.flatnonzero(
+        np.r_[True, (above[1:] != above[:-1]) | (group[1:] != group[:-1])]
+    )
+    run_length = np.diff(np.r_[run_start, len(above)])
+    long_run = np.zeros(len(above), dtype=bool)
+    long_run[run_start[above[run_start] & (run_length >= count)]] = True
+    return segment_first(long_run, group, n_groups)
+
+
+def lowest_point_before(
+    values, flight_start, start, lookback=TAKEOFF_ROLL_LOOKBACK
+) -> np.ndarray:
+    # walk back from start (point index) over at most lookback points of the same flight as long as the values do not rise,
+    # and return the index of the lowest value, same rule as the loop in calculate_takeoff_roll_distance_m
+    steps = np.arange(lookback)
+    # the loop never reaches the first point of the flight
+    valid = steps[None, :] < np.minimum(lookback, start - flight_start)[:, None]
+    valid[:, 0] = True
+    index = np.clip(start[:, None] - steps[None, :], 0, len(values) - 1)
+    window = np.where(valid, values[index], np.nan)
+    lowest = np.fmin.accumulate(window, axis=1)
+    # the walk stops at the first value above the lowest value so far, or at the end of the window
+    stop = ~valid | (window > np.c_[lowest[:, :1], lowest[:, :-1]])
+    stop[:, 0] = False
+    length = np.where(stop.any(axis=1), stop.argmax(axis=1), lookback)
+    final = lowest[np.arange(len(start)), length - 1]
+    # only strictly lower values move the start, so the lowest value is kept at its first occurrence
+    first = (window == final[:, None]) & (steps[None, :] < length[:, None])
+    # a NaN value at start never compares lower, so the start does not move at all
+    moved = first.any(axis=1) & ~np.isnan(window[:, 0])
+    return start - np.where(moved, first.argmax(axis=1), 0)
+
+
+#
+# Helpers
+#
+
+
+def haversine_m(lat1, lon1, lat2, lon2) -> np.ndarray:
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+@cache
+def airport_data() -> dict:
+    import airportsdata
+
+    return airportsdata.load("ICAO")
+
+
+def airport_positions(codes) -> tuple:
+    # latitude, longitude and elevation (ft) for a list of ICAO codes, NaN for unknown airports
+    airports = airport_data()
+    rows = [airports.get(code, {}) for code in codes]
+    return (
+        np.array([row.get("lat", np.nan) for row in rows], dtype=np.float64),
+        np.array([row.get("lon", np.nan) for row in rows], dtype=np.float64),
+        np.array([row.get("elevation", np.nan) for row in rows], dtype=np.float64),
+    )
+
+
+def label_phases(batch: FlightBatch) -> np.ndarray:
+    # same labels as flight.phases(twindow=60), for all flights of the batch at once (see trajectory_phases.py)
+    return label_phases_points(
+        batch.time, batch.altitude, batch.groundspeed, batch.vertical_rate, batch.group
+    )
+
+
+def near_airport(latitude, longitude, altitude, airports) -> np.ndarray:
+    # is position i on or close above airports[i]
+    lat, lon, elevation = airport_positions(airports)
+    distance_km = haversine_m(latitude, longitude, lat, lon) / 1000
+    low = np.isnan(altitude) | (altitude < elevation + AIRPORT_MAX_HEIGHT_FT)
+    return (distance_km < AIRPORT_RADIUS_KM) & low
+
+
+def close_to_airport(batch: FlightBatch, index: np.ndarray, airports) -> np.ndarray:
+    # is the point index[i] (first or last point of flight i) on or close above airports[i]
+    return near_airport(
+        take(batch.latitude, index),
+        take(batch.longitude, index),
+        take(batch.altitude, index),
+        airports,
+    )
+
+
+#
+# Features
+#
+
+
+def track_distance(batch: FlightBatch) -> np.ndarray:
+    # sum of the great circle distances between consecutive points
+    # in nautical miles, as the traffic cumdist column that is used by the batch job
+    step = haversine_m(
+        batch.previous(batch.latitude),
+        batch.previous(batch.longitude),
+        batch.latitude,
+        batch.longitude,
+    )
+    return segment_sum(step, batch.group, len(batch)) / NM_IN_M
+
+
+def trajectory_completeness(batch: FlightBatch, phase: np.ndarray, adep, ades) -> tuple:
+    # has_takeoff/has_landing: the trajectory starts/ends at the airport and has a climb/descent in the first/last hour
+    n = len(batch)
+    valid_position = ~np.isnan(batch.latitude)
+    first = segment_first(valid_position, batch.group, n)
+    last = segment_last(valid_position, batch.group, n)
+    start_time = batch.per_point(segment_min(batch.time, batch.group, n))
+    end_time = batch.per_point(segment_max(batch.time, batch.group, n))
+
+    first_hour_climb = (batch.time < start_time + 3600) & (phase == CLIMB)
+    last_hour_descent = (batch.time > end_time - 3600) & (phase == DESCENT)
+
+    has_takeoff = close_to_airport(batch, first, adep) & (
+        segment_first(first_hour_climb, batch.group, n) >= 0
+    )
+    has_landing = close_to_airport(batch, last, ades) & (
+        segment_first(last_hour_descent, batch.group, n) >= 0
+    )
+    cruise_points = (batch.altitude > 15000) & (batch.altitude < 40000)
+    has_cruise = segment_first(cruise_points, batch.group, n) >= 0
+    return has_takeoff, has_landing, has_cruise
+
+
+def initial_climb_end(batch: FlightBatch, phase: np.ndarray) -> np.ndarray:
+    # position (within the flight) where the initial climb trajectory ends, -1 if it cannot be determined
+    # same rule as get_initial_climb_trajectory: the trajectory ends at the first CLIMB point that does not directly follow
+    # another CLIMB point, or at the second CLIMB point if all CLIMB points are consecutive
+    n = len(batch)
+    climb = np.flatnonzero(phase == CLIMB)
+    climb_group = batch.group[climb]
+    # groups are >= 0, so prepending -1 makes the first CLIMB point start a flight and keeps empty arrays empty
+    new_flight = np.diff(climb_group, prepend=-1) != 0
+    gap = np.zeros(len(batch.group), dtype=bool)
+    gap[climb[~new_flight & (np.diff(climb, prepend=-1) != 1)]] = True
+    second = np.zeros(len(batch.group), dtype=bool)
+    second[climb[~new_flight & np.r_[False, new_flight][:-1]]] = True
+
+    end_at_gap = segment_first(gap, batch.group, n)
+    end_at_second = segment_first(second, batch.group, n)
+    end = np.where(end_at_gap >= 0, end_at_gap, end_at_second)
+    return np.where(end >= 0, end - batch.starts, -1)
+
+
+def takeoff_features(
+    batch: FlightBatch, phase: np.ndarray, has_takeoff: np.ndarray
+) -> dict:
+    n = len(batch)
+    group = batch.group
+    climb_end = np.where(has_takeoff, initial_climb_end(batch, phase), -1)
+    in_climb = batch.position < batch.per_point(climb_end)
+
+    result = {}
+
+    # taxi out time: time between first and last point between 3 knots and the speed threshold
+    taxi = in_climb & (batch.groundspeed > 3) & (batch.groundspeed < SPEED_THRESHOLD)
+    result["taxi_out_time_s"] = segment_max(batch.time, group, n, taxi) - segment_min(
+        batch.time, group, n, taxi
+    )
+
+    # acceleration over the 20 points before and 40 points after the speed threshold is passed
+    above = segment_first(in_climb & (batch.groundspeed > SPEED_THRESHOLD), group, n)
+    above_position = np.where(above >= 0, above - batch.starts, -1)
+    window_start = batch.per_point(np.maximum(above_position - 20, 0))
+    window_end = batch.per_point(np.minimum(above_position + 40, climb_end))
+    in_window = (batch.position > window_start) & (batch.position < window_end)
+    in_window &= batch.per_point(above_position >= 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        acceleration = (
+            (batch.groundspeed - batch.previous(batch.groundspeed))
+            / (batch.time - batch.previous(batch.time))
+            * 0.514444  # convert from knots/s to m/s^2
+        )
+    no_acceleration = above_position < 0
+    result["takeoff_mean_acceleration"] = np.where(
+        no_acceleration, 0, segment_mean(acceleration, group, n, in_window)
+    )
+    result["takeoff_max_acceleration"] = np.where(
+        no_acceleration, 0, segment_max(acceleration, group, n, in_window)
+    )
+
+    # v2: groundspeed at the first point with a positive climb rate
+    first_climb = segment_first(in_climb & (batch.vertical_rate > 200), group, n)
+    result["v2_speed_kt"] = np.where(
+        first_climb >= 0, take(batch.groundspeed, first_climb), -1
+    )
+
+    # takeoff roll: from the lowest speed before the first streak above the speed threshold to the first positive climb rate
+    result["takeoff_roll_distance_m"] = takeoff_roll_distance(
+        batch, in_climb, climb_end, first_climb
+    )
+
+    for name, values in (
+        ("climb", batch.vertical_rate),
+        ("alt", batch.altitude),
+    ):
+        result[f"initclimb_mean_{name}"] = segment_mean(values, group, n, in_climb)
+        result[f"initclimb_median_{name}"] = segment_median(values, group, n, in_climb)
+        result[f"initclimb_max_{name}"] = segment_max(values, group, n, in_climb)
+    result["initclimb_min_gs"] = segment_min(batch.groundspeed, group, n, in_climb)
+    result["initclimb_mean_gs"] = segment_mean(batch.groundspeed, group, n, in_climb)
+    result["initclimb_median_gs"] = segment_median(
+        batch.groundspeed, group, n, in_climb
+    )
+    result["initclimb_max_gs"] = segment_max(batch.groundspeed, group, n, in_climb)
+
+    # flights without a usable takeoff trajectory get no takeoff features
+    valid = climb_end > 0
+    return {key: np.where(valid, value, np.nan) for key, value in result.items()}
+
+
+def takeoff_roll_distance(
+    batch: FlightBatch, in_climb: np.ndarray, climb_end: np.ndarray, roll_end
+) -> np.ndarray:
+    # -1 if the data is not accurate enough, like calculate_takeoff_roll_distance_m
+    streak = first_streak_above(
+        batch.groundspeed,
+        batch.group,
+        len(batch),
+        SPEED_THRESHOLD,
+        TAKEOFF_STREAK,
+        in_climb,
+    )
+    # no streak: start at the last point of the climb trajectory
+    last_climb_point = batch.starts + np.maximum(climb_end, 1) - 1
+    streak = np.where(streak >= 0, streak, last_climb_point)
+    roll_start = lowest_point_before(batch.groundspeed, batch.starts, streak)
+    distance = haversine_m(
+        batch.latitude[roll_start],
+        batch.longitude[roll_start],
+        take(batch.latitude, roll_end),
+        take(batch.longitude, roll_end),
+    )
+    return np.where(roll_end > roll_start, distance, -1)
+
+
+def cruise_features(batch: FlightBatch) -> dict:
+    # altitude and speed on the longest level segment of every flight
+    n = len(batch)
+    group = batch.group
+    at_cruise = batch.level_segments.point_mask(batch.level_segments.cruise())
+    speed = batch.groundspeed
+    return {
+        "cruise_altitude": segment_median(batch.altitude, group, n, at_cruise),
+        "mean_cruise_speed": segment_mean(speed, group, n, at_cruise),
+        "median_cruise_speed": segment_median(speed, group, n, at_cruise),
+        "lowest_cruise_speed": segment_min(speed, group, n, at_cruise),
+        "highest_cruise_speed": segment_max(speed, group, n, at_cruise),
+        "cruise_speed_std": segment_std(speed, group, n, at_cruise),
+    }
+
+
+def headwind(track, u_wind, v_wind) -> np.ndarray:
+    # positive values indicate headwind, negative values indicate tailwind
+    # wind_speed * cos(wind_direction - track) with wind_direction = arctan2(u, v), expanded so no sqrt/arctan2 is needed
+    # in float64 like the per flight version, the features are stored as float64
+    track = np.radians(track.astype(np.float64))
+    return u_wind.astype(np.float64) * np.sin(track) + v_wind.astype(
+        np.float64
+    ) * np.cos(track)
+
+
+def level_flight(altitude) -> np.ndarray:
+    # points that the wind features are computed from
+    return (altitude > 15000) & (altitude < 40000)
+
+
+def wind_statistics(altitude, track, u_wind, v_wind, group, n_groups) -> dict:
+    # headwind statistics of the level flight points, missing winds are skipped like pandas does
+    # all points of the altitude band count, not only the level segments, like the per flight version of the traffic engine
+    level = level_flight(altitude)
+    wind = headwind(track, u_wind, v_wind)
+    return {
+        "average_headwind": segment_mean(wind, group, n_groups, level),
+        "max_headwind": segment_max(wind, group, n_groups, level),
+        "min_headwind": segment_min(wind, group, n_groups, level),
+        "std_headwind": segment_std(wind, group, n_groups, level),
+    }
+
+
+def wind_features(batch: FlightBatch) -> dict:
+    return wind_statistics(
+        batch.altitude,
+        batch.track,
+        batch.u_wind,
+        batch.v_wind,
+        batch.group,
+        len(batch),
+    )
+
+
+def wind_features_day(trajectories: pd.DataFrame) -> pd.DataFrame:
+    # wind features of all flights of a frame sorted by flight_id in one pass, indexed by flight_id
+    # only reads the four columns that are needed, without building a full FlightBatch
+    flight_ids, starts, ends = flight_offsets(trajectories["flight_id"].values)
+    group = np.repeat(np.arange(len(flight_ids)), ends - starts)
+
+    def column(name):
+        if name not in trajectories:
+            return np.full(len(trajectories), np.nan)
+        return trajectories[name].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    altitude = column("altitude")
+    statistics = wind_statistics(
+        altitude,
+        column("track"),
+        column("u_component_of_wind"),
+        column("v_component_of_wind"),
+        group,
+        len(flight_ids),
+    )
+    # flights without any level flight point get -1 in the traffic engine, see add_wind_features
+    statistics["level_points"] = np.bincount(
+        group, weights=level_flight(altitude), minlength=len(flight_ids)
+    )
+    return pd.DataFrame(statistics, index=pd.Index(flight_ids, name="flight_id"))
+
+
+def create_trajectory_features_day(
+    trajectories: pd.DataFrame, flight_lookup: dict
+) -> pd.DataFrame:
+    # same features as trajectory_batchprocessing.create_trajectory_features, for all flights of the frame at once
+    trajectories = trajectories[trajectories["flight_id"].isin(list(flight_lookup))]
+    points = len(trajectories)
+    with stage("flight_batch", points=points):
+        batch = FlightBatch(trajectories)
+    info = [flight_lookup[flight_id] for flight_id in batch.flight_ids.tolist()]
+    adep = [adep for adep, _, _ in info]
+    ades = [ades for _, ades, _ in info]
+
+    with stage("phases", points=points):
+        phase = label_phases(batch)
+    with stage("completeness", points=points):
+        has_takeoff, has_landing, has_cruise = trajectory_completeness(
+            batch, phase, adep, ades
+        )
+
+    with stage("track_distance", points=points):
+        result = {
+            "flight_id": batch.flight_ids.astype(np.int64),
+            "track_distance_m": track_distance(batch),
+            "has_takeoff_trajectory": has_takeoff,
+            "has_landing_trajectory": has_landing,
+            "has_cruise_trajectory": has_cruise,
+        }
+    with stage("takeoff_features", points=points):
+        result.update(takeoff_features(batch, phase, has_takeoff))
+    # same as create_trajectory_features: flights without cruise get -1 for the takeoff features
+    for key in TAKEOFF_FEATURES:
+        result[key] = np.where(has_cruise, result[key], -1)
+    with stage("cruise_features", points=points):
+        cruise = cruise_features(batch)
+    with stage("wind_features", points=points):
+        wind = wind_features(batch)
+    for key, value in {**cruise, **wind}.items():
+        result[key] = np.where(has_cruise, value, np.nan)
+    return pd.DataFrame(result)[FEATURE_COLUMNS]
+
+
+def _as_float(series: pd.Series) -> pd.Series:
+    if series.name.startswith("has_"):
+        # the batch job writes None for flights that fail the airport check
+        return series.eq(True).astype("float64")
+    return series.astype("float64")
+
+
+def compare_features(features: pd.DataFrame, reference: pd.DataFrame) -> pd.DataFrame:
+    # per feature agreement of two feature frames, matched on flight_id
+    merged = features.merge(reference, on="flight_id", suffixes=("", "_reference"))
+    rows = []
+    for column in features.columns:
+        if column == "flight_id" or column not in reference:
+            continue
+        a = _as_float(merged[column])
+        b = _as_float(merged[f"{column}_reference"])
+        both = a.notna() & b.notna()
+        rows.append(
+            {
+                "feature": column,
+                "flights": len(merged),
+                "missing_mismatch": int((a.isna() != b.isna()).sum()),
+                "within_5_percent": np.isclose(
+                    a[both], b[both], rtol=0.05, atol=1e-6
+                ).mean(),
+                "median_abs_diff": (a[both] - b[both]).abs().median(),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def main() -> None:
+    from preprocessing.trajectory_batchprocessing import (
+        FEATURE_VERSION,
+        load_flight_lookup,
+    )
+    from preprocessing.trajectory_feature_store import TrajectoryFeatureStore
+    from preprocessing.trajectory_reader import read_trajectories
+
+    date_file = Path(sys.argv[1])
+    flight_lookup = load_flight_lookup()
+    trajectories = read_trajectories(date_file, flight_lookup)
+
+    start = time.perf_counter()
+    features = create_trajectory_features_day(trajectories, flight_lookup)
+    duration = time.perf_counter() - start
+    print(
+        f"{len(features)} flights, {len(trajectories)} points in {duration:.1f}s "
+        f"({len(features) / duration:.0f} flights/s)"
+    )
+
+    # the traffic engine rows of these flights in the feature store, computed from the same day, are the reference
+    store = TrajectoryFeatureStore()
+    manifest = store.current_entries(date_file.stem)
+    reference_ids = manifest.loc[
+        (manifest["version"] == f"traffic-{FEATURE_VERSION}")
+        & manifest["flight_id"].isin(features["flight_id"]),
+        "flight_id",
+    ]
+    if len(reference_ids):
+        reference = store.read_features(reference_ids, date_file.stem)
+        print(compare_features(features, reference).to_string())
+    else:
+        print(
+            f"No traffic engine features of these flights in {store.path}, skipping validation."
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+#
+# Incremental store for the trajectory features
+# The features are appended as parquet parts, the manifest records for every flight_id and day a fingerprint of its trajectory,
+# its number of points, the version of the feature code and the part that holds its features.
+# A flight that crosses midnight is in two daily files, each day keeps its own entry so the halves do not overwrite each
+# other, and the features of the day with most of the flight's points are read.
+# The batch job only computes flights that are missing or whose fingerprint/version changed, and days whose file did not change
+# since they were completed are not read at all.
+# Flights whose feature extraction failed are kept in a failure table until a later run computes them successfully.
+# Parts whose flights have all been recomputed are deleted, so reruns and version bumps do not grow the store on disk.
+#
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+root_dir = Path(__file__).parent.parent.absolute()
+store_dir = root_dir / "additional_data" / "trajectory_features" / "store"
+
+# columns that go into the fingerprint of a trajectory
+FINGERPRINT_COLUMNS = [
+    "timestamp",
+    "latitude",
+    "longitude",
+    "altitude",
+    "groundspeed",
+    "track",
+    "vertical_rate",
+    "u_component_of_wind",
+    "v_component_of_wind",
+]
+
+
+def flight_fingerprints(flights: pd.DataFrame) -> pd.Series:
+    # one uint64 per flight, indexed by flight_id, flights has to be sorted by flight_id
+    if len(flights) == 0:
+        return pd.Series([], dtype=np.uint64)
+    columns = [c for c in FINGERPRINT_COLUMNS if c in flights]
+    row_hash = pd.util.hash_pandas_object(flights[columns], index=False).values
+    flight_ids = flights["flight_id"].values
+    starts = np.flatnonzero(np.r_[True, flight_ids[1:] != flight_ids[:-1]])
+    counts = np.diff(np.r_[starts, len(flights)])
+    # weight every row by its position within the flight, so reordered points change the fingerprint
+    position = np.arange(len(flights)) - np.repeat(starts, counts)
+    weighted = row_hash * (2 * position.astype(np.uint64) + 1)
+    fingerprint = np.add.reduceat(weighted, starts) ^ counts.astype(np.uint64)
+    return pd.Series(fingerprint, index=flight_ids[starts])
+
+
+def flight_points(flights: pd.DataFrame) -> pd.Series:
+    # number of points per flight, indexed by flight_id, flights has to be sorted by flight_id
+    if len(flights) == 0:
+        return pd.Series([], dtype=np.int64)
+    flight_ids = flights["flight_id"].values
+    starts = np.flatnonzero(np.r_[True, flight_ids[1:] != flight_ids[:-1]])
+    counts = np.diff(np.r_[starts, len(flights)])
+    return pd.Series(counts, index=flight_ids[starts], dtype=np.int64)
+
+
+def part_day(part: str) -> str:
+    # the parts are named part-<day>-<8 hex digits>.parquet, see TrajectoryFeatureStore.append
+    return part[len("part-") : -len("-00000000.parquet")]
+
+
+def flight_list_fingerprint(flight_ids) -> str:
+    # changes whenever flights are added to or removed from challenge_set/final_submission_set
+    flight_ids = np.sort(np.fromiter(flight_ids, dtype=np.int64))
+    return hashlib.md5(flight_ids.tobytes()).hexdigest()
+
+
+class TrajectoryFeatureStore:
+    def __init__(self, path: Path = store_dir) -> None:
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.manifest_file = self.path / "manifest.parquet"
+        self.days_file = self.path / "days.json"
+        self.failures_file = self.path / "failures.parquet"
+
+        if self.manifest_file.exists():
+            self.manifest = pd.read_parquet(self.manifest_file)
+        else:
+            self.manifest = pd.DataFrame(
+                {
+                    "flight_id": pd.Series([], dtype=np.int64),
+                    "day": pd.Series([], dtype=str),
+                    "fingerprint": pd.Series([], dtype=np.uint64),
+                    "points": pd.Series([], dtype=np.int64),
+                    "version": pd.Series([], dtype=str),
+                    "part": pd.Series([], dtype=str),
+                }
+            )
+        if "day" not in self.manifest:
+            # manifests with one entry per flight, the day is in the name of the part
+            self.manifest.insert(1, "day", self.manifest["part"].map(part_day))
+            self.manifest.insert(3, "points", np.int64(0))
+        # (flight_id, day) -> (fingerprint, version) for fast staleness checks
+        self.known = dict(
+            zip(
+                zip(self.manifest["flight_id"].tolist(), self.manifest["day"]),
+                zip(self.manifest["fingerprint"].tolist(), self.manifest["version"]),
+            )
+        )
+        self.days = (
+            json.loads(self.days_file.read_text()) if self.days_file.exists() else {}
+        )
+        if self.failures_file.exists():
+            self.failures = pd.read_parquet(self.failures_file)
+        else:
+            self.failures = pd.DataFrame(
+                {
+                    "flight_id": pd.Series([], dtype=np.int64),
+                    "day": pd.Series([], dtype=str),
+                    "stage": pd.Series([], dtype=str),
+                    "exception": pd.Series([], dtype=str),
+                    "points": pd.Series([], dtype=np.int64),
+                    "attempts": pd.Series([], dtype=np.int64),
+                    "version": pd.Series([], dtype=str),
+                }
+            )
+
+    def __len__(self) -> int:
+        # number of flights, a flight that crosses midnight has an entry for both days
+        return self.manifest["flight_id"].nunique()
+
+    def is_stale(self, fingerprints: pd.Series, versions: set, day: str) -> pd.Series:
+        # True for flights of the day that are missing, changed or computed with an outdated feature version
+        stale = [
+            (entry := self.known.get((flight_id, day))) is None
+            or entry[0] != fingerprint
+            or entry[1] not in versions
+            for flight_id, fingerprint in zip(
+                fingerprints.index.tolist(), fingerprints.tolist()
+            )
+        ]
+        return pd.Series(stale, index=fingerprints.index, dtype=bool)
+
+    def append(
+        self,
+        features: pd.DataFrame,
+        fingerprints: pd.Series,
+        points: pd.Series,
+        version: str,
+        name: str,
+    ) -> None:
+        # write the features as a new part and point the manifest entries of these flights and this day (name) to it
+        fingerprints = fingerprints[fingerprints.index.isin(features["flight_id"])]
+        part = f"part-{name}-{uuid.uuid4().hex[:8]}.parquet"
+        features.to_parquet(self.path / part, index=False)
+
+        entries = pd.DataFrame(
+            {
+                "flight_id": fingerprints.index.astype(np.int64),
+                "day": name,
+                "fingerprint": fingerprints.values.astype(np.uint64),
+                "points": points.reindex(fingerprints.index, fill_value=0).values,
+                "version": version,
+                "part": part,
+            }
+        )
+        self._add_entries(entries)
+
+    @staticmethod
+    def _keys(frame: pd.DataFrame) -> pd.MultiIndex:
+        return pd.MultiIndex.from_arrays(
+            [frame["flight_id"].astype(np.int64), frame["day"].astype(str)]
+        )
+
+    def _add_entries(self, entries: pd.DataFrame) -> None:
+        # point the manifest entries of these flights and days to their new part
+        previous_parts = set(self.manifest["part"])
+        replaced = self._keys(self.manifest).isin(self._keys(entries))
+        self.manifest = pd.concat(
+            [self.manifest[~replaced], entries[self.manifest.columns]],
+            ignore_index=True,
+        )
+        self.known.update(
+            zip(
+                zip(entries["flight_id"].tolist(), entries["day"]),
+                zip(entries["fingerprint"].tolist(), entries["version"]),
+            )
+        )
+        self._write(self.manifest, self.manifest_file)
+        # parts whose flights have all been recomputed are not needed anymore, only removed once the manifest is written
+        for part in previous_parts - set(self.manifest["part"]):
+            (self.path / part).unlink(missing_ok=True)
+
+        # flights that failed on a day before and are computed now are no failures anymore
+        solved = self._keys(self.failures).isin(self._keys(entries))
+        if solved.any():
+            self.failures = self.failures[~solved].reset_index(drop=True)
+            self._write(self.failures, self.failures_file)
+
+    @staticmethod
+    def _write(frame: pd.DataFrame, file: Path) -> None:
+        # write to a temporary file first, so a crash never leaves a broken file behind
+        tmp_file = file.with_suffix(".tmp")
+        frame.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, file)
+
+    def record_failures(self, failures: list, version: str, name: str) -> None:
+        # failures are dicts with flight_id, stage, exception and points, as returned by the scheduler
+        if not failures:
+            return
+        entries = pd.DataFrame(failures).assign(day=name, version=version)
+        entries = entries.drop_duplicates("flight_id", keep="last")
+        previous = self.failures.set_index(self._keys(self.failures))["attempts"]
+        entries["attempts"] = (
+            previous.reindex(self._keys(entries)).fillna(0).astype(np.int64).values + 1
+        )
+        self.failures = pd.concat(
+            [
+                self.failures[~self._keys(self.failures).isin(self._keys(entries))],
+                entries[self.failures.columns],
+            ],
+            ignore_index=True,
+        )
+        self._write(self.failures, self.failures_file)
+
+    @staticmethod
+    def _file_state(date_file: Path) -> dict:
+        stat = date_file.stat()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    @classmethod
+    def day_state_matches(
+        cls, day: dict, date_file: Path, versions: set, flight_list: str
+    ) -> bool:
+        # day (an entry of days.json) was completed with the same list of flights and the file did not change since
+        return (
+            day is not None
+            and day["version"] in versions
+            and day["flight_list"] == flight_list
+            and {k: day[k] for k in ("size", "mtime_ns")} == cls._file_state(date_file)
+        )
+
+    def day_done(self, date_file: Path, versions: set, flight_list: str) -> bool:
+        return self.day_state_matches(
+            self.days.get(date_file.stem), date_file, versions, flight_list
+        )
+
+    def mark_day(self, date_file: Path, version: str, flight_list: str) -> None:
+        self.days[date_file.stem] = {
+            **self._file_state(date_file),
+            "version": version,
+            "flight_list": flight_list,
+        }
+        self._write_days()
+
+    def _write_days(self) -> None:
+        tmp_file = self.days_file.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps(self.days, indent=1))
+        os.replace(tmp_file, self.days_file)
+
+    def merge_from(self, other: "TrajectoryFeatureStore") -> int:
+        # take over the flights, days and failures of another store (the store of one node of a --shared run)
+        # the parts are copied, flights that are already here with the same fingerprint and version are skipped,
+        # so merging the same store again does nothing. Returns the number of flights taken over.
+        if other.manifest.empty and not other.days and other.failures.empty:
+            # e.g. a node that did not get any day
+            return 0
+        new = np.array(
+            [
+                self.known.get((flight_id, day)) != (fingerprint, version)
+                for flight_id, day, fingerprint, version in zip(
+                    other.manifest["flight_id"].tolist(),
+                    other.manifest["day"],
+                    other.manifest["fingerprint"].tolist(),
+                    other.manifest["version"],
+                )
+            ],
+            dtype=bool,
+        )
+        entries = other.manifest[new]
+        for part in entries["part"].unique():
+            if not (self.path / part).exists():
+                tmp_file = (self.path / part).with_suffix(".tmp")
+                shutil.copyfile(other.path / part, tmp_file)
+                os.replace(tmp_file, self.path / part)
+        if len(entries):
+            self._add_entries(entries.reset_index(drop=True))
+
+        if other.days:
+            self.days.update(other.days)
+            self._write_days()
+
+        # failures of flights that are computed in this store (by now) are no failures anymore
+        failures = pd.concat(
+            [
+                self.failures[
+                    ~self._keys(self.failures).isin(self._keys(other.failures))
+                ],
+                other.failures,
+            ],
+            ignore_index=True,
+        )
+        self.failures = failures[
+            ~self._keys(failures).isin(list(self.known))
+        ].reset_index(drop=True)
+        self._write(self.failures, self.failures_file)
+        return len(entries)
+
+    def current_entries(self, day: str = None) -> pd.DataFrame:
+        # one manifest entry per flight: the day with most of its points (the earlier day on a tie), or the entries of day
+        if day is not None:
+            return self.manifest[self.manifest["day"] == day]
+        return self.manifest.sort_values(
+            ["points", "day"], ascending=[False, True], kind="stable"
+        ).drop_duplicates("flight_id")
+
+    def iter_features(self, flight_ids=None, day: str = None):
+        # yields the current features of all (or the given) flights, one frame per part
+        manifest = self.current_entries(day)
+        if flight_ids is not None:
+            manifest = manifest[manifest["flight_id"].isin(flight_ids)]
+        for part, part_flights in manifest.groupby("part")["flight_id"]:
+            features = pd.read_parquet(self.path / part)
+            yield features[features["flight_id"].isin(part_flights)]
+
+    def read_features(self, flight_ids=None, day: str = None) -> pd.DataFrame:
+        # the current features of all (or the given) flights, with day the features computed from that day's file
+        frames = list(self.iter_features(flight_ids, day))
+        if not frames:
+            return pd.DataFrame(columns=["flight_id"])
+        return pd.concat(frames, join="outer", ignore_index=True)
+
+    def remove_unreferenced_parts(self) -> int:
+        # parts that no manifest entry points to, e.g. left behind by a crash between writing a part and the manifest
+        referenced = set(self.manifest["part"])
+        removed = 0
+        for part in self.path.glob("part-*.parquet"):
+            if part.name not in referenced:
+                part.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def write_merged(self, file: Path, schema: pa.Schema) -> int:
+        # stream the current features into one parquet file, one row group per part, so only one part is in memory at a time
+        # every part is cast to schema, parts without a (float) column get NaN
+        self.remove_unreferenced_parts()
+        rows = 0
+        tmp_file = file.with_suffix(".tmp")
+        with pq.ParquetWriter(tmp_file, schema) as writer:
+            for features in self.iter_features():
+                features = features.reindex(columns=schema.names)
+                writer.write_table(
+                    pa.Table.from_pandas(features, schema=schema, preserve_index=False)
+                )
+                rows += len(features)
+        os.replace(tmp_file, file)
+        return rows
@@ -0,0 +1,204 @@
+#
+# Flight_id index over the daily trajectory files, for loading single flights without reading a whole day
+# Indexing rewrites every day sorted by flight_id (original point order within a flight) into an uncompressed Arrow IPC
+# file, and index.parquet maps every flight_id to (day, offset, length) of its rows. A flight is then a zero-copy slice of
+# the memory mapped file, which takes milliseconds instead of reading and filtering the parquet file of its day.
+# Flights that span midnight are in two daily files and have an entry for each of them.
+# The batch job reads the indexed file of a day instead of the parquet file, as long as it was built from the current file.
+#
+# Usage:
+#   python ./preprocessing/trajectory_index.py              (indexes all new or changed days in data/)
+#   python ./preprocessing/trajectory_index.py 248763780    (loads one flight and reports how long it took)
+#
+# In a notebook:
+#   index = TrajectoryIndex()
+#   flight = Flight(index.flight(248763780))
+#
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+root_dir = Path(__file__).parent.parent.absolute()
+trajectory_data_dir = root_dir / "data"
+index_dir = root_dir / "additional_data" / "trajectory_index"
+
+IPC_CHUNK_ROWS = 1_000_000  # rows per record batch of the indexed files
+OPEN_DAYS = 16  # memory mapped days kept open by TrajectoryIndex
+
+
+def indexed_path(date_file: Path, path: Path = index_dir) -> Path:
+    return Path(path) / f"{Path(date_file).stem}.arrow"
+
+
+def _source_state(date_file: Path) -> dict:
+    stat = Path(date_file).stat()
+    return {
+        b"source_size": str(stat.st_size),
+        b"source_mtime_ns": str(stat.st_mtime_ns),
+    }
+
+
+def indexed_file(date_file: Path, path: Path = index_dir) -> Path:
+    # the indexed file of the day if it was built from the current version of date_file, otherwise date_file itself
+    ipc_file = indexed_path(date_file, path)
+    if not ipc_file.exists():
+        return date_file
+    try:
+        metadata = pa.ipc.open_file(pa.memory_map(str(ipc_file))).schema.metadata
+    except pa.ArrowInvalid:
+        # e.g. a file that was not written completely
+        return date_file
+    state = _source_state(date_file)
+    if metadata is None or any(metadata.get(k) != v.encode() for k, v in state.items()):
+        return date_file
+    return ipc_file
+
+
+def index_day(date_file: Path, path: Path = index_dir) -> pd.DataFrame:
+    # writes the day sorted by flight_id as arrow ipc file, returns the (flight_id, day, offset, length) of its flights
+    table = pq.read_table(date_file)
+    # the sort is stable, so the points of a flight keep their order
+    table = table.take(pc.sort_indices(table, sort_keys=[("flight_id", "ascending")]))
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), **_source_state(date_file)}
+    )
+
+    ipc_file = indexed_path(date_file, path)
+    tmp_file = ipc_file.with_suffix(".tmp")
+    # uncompressed, so the file can be memory mapped and sliced without decoding
+    with pa.ipc.new_file(tmp_file, table.schema) as writer:
+        writer.write_table(table, max_chunksize=IPC_CHUNK_ROWS)
+    tmp_file.replace(ipc_file)
+
+    flight_id = table["flight_id"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, flight_id[1:] != flight_id[:-1]])
+    lengths = np.diff(np.r_[starts, len(flight_id)])
+    return pd.DataFrame(
+        {
+            "flight_id": flight_id[starts].astype(np.int64),
+            "day": ipc_file.stem,
+            "offset": starts.astype(np.int64),
+            "length": lengths.astype(np.int64),
+        }
+    )
+
+
+def build_index(
+    date_files: list = None, path: Path = index_dir, force: bool = False
+) -> pd.DataFrame:
+    # indexes all days whose indexed file is missing or older than their parquet file and rewrites index.parquet
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    if date_files is None:
+        date_files = sorted(trajectory_data_dir.glob("*.parquet"))
+    index_file = path / "index.parquet"
+    index = pd.read_parquet(index_file) if index_file.exists() else None
+
+    todo = [
+        date_file
+        for date_file in date_files
+        if force
+        or index is None
+        or indexed_file(date_file, path) == date_file
+        or not (index["day"] == date_file.stem).any()
+    ]
+    if not todo:
+        print("All days are indexed.")
+        return index
+
+    days = [index_day(date_file, path) for date_file in tqdm(todo)]
+    if index is not None:
+        days.insert(0, index[~index["day"].isin([f.stem for f in todo])])
+    index = pd.concat(days, ignore_index=True)
+    tmp_file = index_file.with_suffix(".tmp")
+    index.to_parquet(tmp_file, index=False)
+    tmp_file.replace(index_file)
+    print(f"Indexed {len(todo)} days, {index['flight_id'].nunique()} flights.")
+    return index
+
+
+class TrajectoryIndex:
+    def __init__(self, path: Path = index_dir) -> None:
+        self.path = Path(path)
+        index = pd.read_parquet(self.path / "index.parquet")
+        # flight_id -> rows of the index, a flight spanning midnight has one per day
+        index = index.sort_values(["flight_id", "day"], ignore_index=True)
+        self.days = index["day"].values
+        self.offsets = index["offset"].values
+        self.lengths = index["length"].values
+        flight_ids = index["flight_id"].values
+        starts = np.flatnonzero(np.r_[True, flight_ids[1:] != flight_ids[:-1]])
+        self.entries = dict(
+            zip(
+                flight_ids[starts].tolist(),
+                zip(starts.tolist(), np.diff(np.r_[starts, len(flight_ids)]).tolist()),
+            )
+        )
+        self.tables = {}  # day -> memory mapped table, most recently used last
+
+    def __contains__(self, flight_id) -> bool:
+        return flight_id in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _table(self, day: str) -> pa.Table:
+        table = self.tables.pop(day, None)
+        if table is None:
+            ipc_file = self.path / f"{day}.arrow"
+            table = pa.ipc.open_file(pa.memory_map(str(ipc_file))).read_all()
+            if len(self.tables) >= OPEN_DAYS:
+                self.tables.pop(next(iter(self.tables)))
+        self.tables[day] = table
+        return table
+
+    def flight_table(self, flight_id, columns: list = None) -> pa.Table:
+        # zero-copy slice(s) of the memory mapped day(s) of the flight
+        if flight_id not in self.entries:
+            raise KeyError(f"flight {flight_id} is not in the trajectory index")
+        start, count = self.entries[flight_id]
+        slices = []
+        for i in range(start, start + count):
+            table = self._table(self.days[i])
+            if columns is not None:
+                table = table.select(columns)
+            slices.append(table.slice(int(self.offsets[i]), int(self.lengths[i])))
+        return slices[0] if len(slices) == 1 else pa.concat_tables(slices)
+
+    def flight(self, flight_id, columns: list = None) -> pd.DataFrame:
+        # the points of one flight, as they are in the daily files
+        return self.flight_table(flight_id, columns).to_pandas()
+
+    def flights(self, flight_ids, columns: list = None) -> pd.DataFrame:
+        return pa.concat_tables(
+            [self.flight_table(flight_id, columns) for flight_id in flight_ids]
+        ).to_pandas()
+
+
+def main() -> None:
+    if len(sys.argv) > 1:
+        flight_id = int(sys.argv[1])
+        start = time.perf_counter()
+        index = TrajectoryIndex()
+        opened = time.perf_counter()
+        flight = index.flight(flight_id)
+        loaded = time.perf_counter()
+        print(flight)
+        print(
+            f"index opened in {(opened - start) * 1000:.1f}ms, "
+            f"{len(flight)} points loaded in {(loaded - opened) * 1000:.1f}ms"
+        )
+        return
+    build_index()
+
+
+if __name__ == "__main__":
+    main()
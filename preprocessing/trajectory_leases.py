@@ -0,0 +1,123 @@
+#
+# Coordinator free work queue on a shared directory (e.g. NFS) for running the trajectory batch job on several hosts
+# Every node claims a daily file by creating a lease file with O_EXCL, only one node can create it. A background thread keeps
+# touching the leases of the node, so a lease whose mtime is older than the ttl belongs to a crashed node: it is reclaimed by
+# creating the next generation of the lease file, which again only one node can do. Finished work items get a done marker
+# with the state they were finished with, so other nodes skip them.
+# The clocks of the hosts have to be roughly in sync (NTP), as the lease expiry compares file mtimes with the local time.
+#
+
+import json
+import os
+import socket
+import time
+import uuid
+from pathlib import Path
+from threading import Event, Thread
+
+LEASE_TTL_S = 600  # a lease that was not renewed for this long is considered dead
+# wait between two rounds over the work items that are leased by other nodes
+POLL_S = 30
+
+
+class LeaseQueue:
+    def __init__(self, path: Path, node: str = None, ttl: float = LEASE_TTL_S) -> None:
+        self.path = Path(path)
+        self.lease_dir = self.path / "leases"
+        self.done_dir = self.path / "done"
+        self.lease_dir.mkdir(parents=True, exist_ok=True)
+        self.done_dir.mkdir(parents=True, exist_ok=True)
+        self.node = node or f"{socket.gethostname()}-{os.getpid()}"
+        self.ttl = ttl
+        self.held = {}  # name -> (generation, lease file) of the leases of this node
+
+        self._stop = Event()
+        self._heartbeat = Thread(target=self._renew, daemon=True)
+        self._heartbeat.start()
+
+    def _renew(self) -> None:
+        # keep the leases of this node alive
+        while not self._stop.wait(self.ttl / 3):
+            for _, lease in list(self.held.values()):
+                try:
+                    os.utime(lease)
+                except FileNotFoundError:
+                    pass
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _leases(self, name: str) -> list:
+        # (generation, file) of all lease files of name, oldest first
+        leases = []
+        for lease in self.lease_dir.glob(f"{name}.lease.*"):
+            suffix = lease.name.rsplit(".", 1)[-1]
+            if suffix.isdigit():
+                leases.append((int(suffix), lease))
+        return sorted(leases)
+
+    def _expired(self, lease: Path) -> bool:
+        try:
+            return time.time() - lease.stat().st_mtime > self.ttl
+        except FileNotFoundError:
+            return True
+
+    def claim(self, name: str) -> bool:
+        # True if this node holds the lease of name now
+        if name in self.held:
+            return True
+        leases = self._leases(name)
+        if leases and not self._expired(leases[-1][1]):
+            return False
+        generation = leases[-1][0] + 1 if leases else 0
+        lease = self.lease_dir / f"{name}.lease.{generation}"
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # another node was faster
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"node": self.node, "claimed": time.time()}, f)
+        self.held[name] = (generation, lease)
+        if leases:
+            print(f"{self.node}: reclaimed the expired lease of {name}")
+        return True
+
+    def release(self, name: str) -> None:
+        # give the lease back without marking the work item as done
+        # the older, dead generations are only removed now, so the generations of a held lease never go backwards
+        generation, _ = self.held.pop(name, (None, None))
+        if generation is None:
+            return
+        for old_generation, lease in self._leases(name):
+            if old_generation <= generation:
+                lease.unlink(missing_ok=True)
+
+    def finish(self, name: str, state: dict) -> None:
+        # mark name as done with state (compared by the caller to decide whether it has to be done again) and release it
+        marker = self.done_dir / f"{name}.json"
+        tmp_file = marker.with_suffix(f".{uuid.uuid4().hex[:8]}.tmp")
+        tmp_file.write_text(json.dumps({**state, "node": self.node}))
+        os.replace(tmp_file, marker)
+        self.release(name)
+
+    def done_state(self, name: str):
+        # the state name was finished with, None if it is not done
+        marker = self.done_dir / f"{name}.json"
+        try:
+            return json.loads(marker.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def claim_each(self, items: list, key, done):
+        # one round over the items: yields those that are not done (done(item) is False) and that this node could claim
+        # items leased by other nodes are skipped, the caller retries them after POLL_S, when the leases of crashed nodes
+        # have expired
+        for item in items:
+            if done(item) or not self.claim(key(item)):
+                continue
+            if done(item):
+                # finished by another node between the check and the claim
+                self.release(key(item))
+                continue
+            yield item
@@ -0,0 +1,260 @@
+#
+# Batch version of the OpenAP fuzzy logic phase labelling behind traffic's flight.phases(twindow=60)
+# flight.phases runs the fuzzy rules window by window in python for every single flight. Here the 60 s windows of all flights
+# of a day are runs of contiguous points (the points are sorted by flight_id and time), so the window means are one reduceat
+# and the membership functions, rules and defuzzification are evaluated for all windows at once.
+# Same quirks as openap.phase.FlightPhase.phaselabel: the last window of every flight stays NA and a NaN window mean
+# behaves like in the python min()/np.fmin() calls there.
+#
+# Usage (labels one day, reports the throughput and the agreement with openap on a sample of flights):
+#   python ./preprocessing/trajectory_phases.py data/2022-01-01.parquet
+#
+
+import sys
+import time
+from functools import cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+root_dir = Path(__file__).parent.parent.absolute()
+
+TWINDOW = 60  # seconds, same as flight.phases(twindow=60)
+AGREEMENT_SAMPLE = 500  # flights that are labelled with openap for the agreement report
+
+# phase codes, PHASE_NAMES maps them back to the labels used by traffic
+GROUND, CLIMB, DESCENT, LEVEL, CRUISE, NA = range(6)
+PHASE_NAMES = np.array(["GROUND", "CLIMB", "DESCENT", "LEVEL", "CRUISE", "NA"])
+
+# universes of the openap membership functions, the window means are clipped to them
+ALT_RANGE = np.arange(0, 40000, 1)
+ROC_RANGE = np.arange(-4000, 4000, 0.1)
+SPD_RANGE = np.arange(0, 600, 1)
+STATES = np.arange(0, 6, 0.01)
+# phase of the defuzzified openap states 1 (GND), 2 (CL), 3 (DE), 4 (CR), 5 (LVL), 6 is not mapped by openap
+STATE_PHASES = np.array([NA, GROUND, CLIMB, DESCENT, CRUISE, LEVEL, NA], dtype=np.int8)
+
+
+def gaussmf(x, mean: float, sigma: float) -> np.ndarray:
+    return np.exp(-((x - mean) ** 2) / (2 * sigma**2))
+
+
+def zmf(x, a: float, b: float) -> np.ndarray:
+    y = np.ones(len(x))
+    falling = (a <= x) & (x < (a + b) / 2)
+    y[falling] = 1 - 2 * ((x[falling] - a) / (b - a)) ** 2
+    rising = ((a + b) / 2 <= x) & (x <= b)
+    y[rising] = 2 * ((x[rising] - b) / (b - a)) ** 2
+    y[x >= b] = 0
+    return y
+
+
+def smf(x, a: float, b: float) -> np.ndarray:
+    y = np.ones(len(x))
+    y[x <= a] = 0
+    rising = (a <= x) & (x <= (a + b) / 2)
+    y[rising] = 2 * ((x[rising] - a) / (b - a)) ** 2
+    falling = ((a + b) / 2 <= x) & (x <= b)
+    y[falling] = 1 - 2 * ((x[falling] - b) / (b - a)) ** 2
+    return y
+
+
+@cache
+def memberships() -> dict:
+    # the membership functions sampled on their universe, interpolated like openap's interp_membership
+    return {
+        "alt_gnd": (ALT_RANGE, zmf(ALT_RANGE, 0, 200)),
+        "alt_lo": (ALT_RANGE, gaussmf(ALT_RANGE, 10000, 10000)),
+        "alt_hi": (ALT_RANGE, gaussmf(ALT_RANGE, 35000, 20000)),
+        "roc_zero": (ROC_RANGE, gaussmf(ROC_RANGE, 0, 100)),
+        "roc_plus": (ROC_RANGE, smf(ROC_RANGE, 10, 1000)),
+        "roc_minus": (ROC_RANGE, zmf(ROC_RANGE, -1000, -10)),
+        "spd_hi": (SPD_RANGE, gaussmf(SPD_RANGE, 600, 100)),
+        "spd_md": (SPD_RANGE, gaussmf(SPD_RANGE, 300, 100)),
+        "spd_lo": (SPD_RANGE, gaussmf(SPD_RANGE, 0, 50)),
+    }
+
+
+@cache
+def state_tails() -> list:
+    # for every state 1..5: index of its peak in STATES and its output membership right of the peak (decreasing)
+    tails = []
+    for state in range(1, 6):
+        peak = int(np.searchsorted(STATES, state - 1e-9))
+        tails.append((peak, gaussmf(STATES[peak:], state, 0.1)))
+    return tails
+
+
+def membership(name: str, values: np.ndarray) -> np.ndarray:
+    universe, mf = memberships()[name]
+    return np.interp(values, universe, mf, left=0, right=0)
+
+
+def _min(*values) -> np.ndarray:
+    # element wise python min(): keeps the first value unless a later one is smaller, so NaN only wins in first place
+    result = values[0]
+    for value in values[1:]:
+        result = np.where(value < result, value, result)
+    return result
+
+
+def defuzzify(rules: np.ndarray) -> np.ndarray:
+    # openap state per window, from the firing strength of the five rules (n_windows x 5)
+    # np.fmin(rule, state_mf) ignores a NaN rule, so it fires like a rule with strength 1
+    rules = np.where(np.isnan(rules), 1.0, rules)
+    strength = rules.max(axis=1)
+    # largest of maximum: the last state that reaches the strength, as far right as its output membership stays above it
+    state = 5 - np.argmax(rules[:, ::-1] == strength[:, None], axis=1)
+    state_raw = np.empty(len(rules))
+    for i, (peak, tail) in enumerate(state_tails()):
+        selected = state == i + 1
+        # tail is decreasing, count the points that are still >= strength
+        above = np.searchsorted(-tail, -strength[selected], side="right")
+        state_raw[selected] = STATES[peak + np.maximum(above, 1) - 1]
+    return np.clip(np.round(state_raw), 1, 6).astype(np.int64)
+
+
+def label_phases(
+    time_s, altitude, groundspeed, vertical_rate, group, twindow=TWINDOW
+) -> np.ndarray:
+    # phase code of every point, the points have to be sorted by group and by time within a group
+    n_points = len(group)
+    phase = np.full(n_points, NA, dtype=np.int8)
+    if n_points == 0:
+        return phase
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    counts = np.diff(np.r_[starts, n_points])
+
+    # windows of twindow seconds since the first point of the flight, timestamps truncated to seconds like traffic
+    seconds = np.floor(time_s)
+    window = (seconds - np.repeat(seconds[starts], counts)) // twindow
+    run_start = np.flatnonzero(
+        np.r_[True, (group[1:] != group[:-1]) | (window[1:] != window[:-1])]
+    )
+    run_count = np.diff(np.r_[run_start, n_points])
+    # openap only labels the windows before the last one of the flight
+    last_window = np.repeat(np.maximum.reduceat(window, starts), counts)
+    labelled = window[run_start] < last_window[run_start]
+    if not labelled.any():
+        return phase
+
+    def window_mean(values, universe):
+        # NaN in a window gives a NaN mean, like np.mean
+        values = np.asarray(values, dtype=np.float64)
+        mean = np.add.reduceat(values, run_start)[labelled] / run_count[labelled]
+        return np.clip(mean, universe[0], universe[-1])
+
+    alt = window_mean(altitude, ALT_RANGE)
+    spd = window_mean(groundspeed, SPD_RANGE)
+    roc = window_mean(vertical_rate, ROC_RANGE)
+
+    alt_gnd, alt_lo, alt_hi = (
+        membership(m, alt) for m in ("alt_gnd", "alt_lo", "alt_hi")
+    )
+    spd_hi, spd_md, spd_lo = (
+        membership(m, spd) for m in ("spd_hi", "spd_md", "spd_lo")
+    )
+    roc_zero, roc_plus, roc_minus = (
+        membership(m, roc) for m in ("roc_zero", "roc_plus", "roc_minus")
+    )
+    # same rules and order as openap: ground, climb, descent, cruise, level
+    rules = np.column_stack(
+        [
+            _min(alt_gnd, roc_zero, spd_lo),
+            _min(alt_lo, roc_plus, spd_md),
+            _min(alt_lo, roc_minus, spd_md),
+            _min(alt_hi, roc_zero, spd_hi),
+            _min(alt_lo, roc_zero, spd_md),
+        ]
+    )
+    # broadcast the phase of every window to its points
+    run_phase = np.full(len(run_start), NA, dtype=np.int8)
+    run_phase[labelled] = STATE_PHASES[defuzzify(rules)]
+    return np.repeat(run_phase, run_count)
+
+
+def phase_labels(trajectories: pd.DataFrame) -> np.ndarray:
+    # phase names ("CLIMB", ...) of every point of a frame sorted by flight_id, like the phase column of flight.phases
+    flight_ids = trajectories["flight_id"].values
+    group = np.cumsum(np.r_[False, flight_ids[1:] != flight_ids[:-1]])
+    timestamps = trajectories["timestamp"].values.astype("datetime64[s]")
+    phase = label_phases(
+        timestamps.astype(np.int64).astype(np.float64),
+        trajectories["altitude"].to_numpy(dtype=np.float64, na_value=np.nan),
+        trajectories["groundspeed"].to_numpy(dtype=np.float64, na_value=np.nan),
+        trajectories["vertical_rate"].to_numpy(dtype=np.float64, na_value=np.nan),
+        group,
+    )
+    return PHASE_NAMES[phase].astype(object)
+
+
+def openap_phases(trajectory: pd.DataFrame, twindow=TWINDOW) -> np.ndarray:
+    # reference labels of one flight, the way traffic's flight.phases calls openap
+    from openap.phase import FlightPhase
+
+    fp = FlightPhase()
+    fp.set_trajectory(
+        trajectory["timestamp"].values.astype("datetime64[s]").astype(np.int64),
+        trajectory["altitude"].to_numpy(dtype=np.float64, na_value=np.nan),
+        trajectory["groundspeed"].to_numpy(dtype=np.float64, na_value=np.nan),
+        trajectory["vertical_rate"].to_numpy(dtype=np.float64, na_value=np.nan),
+    )
+    labels = {"GND": GROUND, "CL": CLIMB, "DE": DESCENT, "CR": CRUISE, "LVL": LEVEL}
+    return np.array([labels.get(label, NA) for label in fp.phaselabel(twindow)])
+
+
+def main() -> None:
+    from preprocessing.trajectory_reader import read_trajectories
+
+    date_file = Path(sys.argv[1])
+    trajectories = read_trajectories(date_file).sort_values(
+        "flight_id", kind="stable", ignore_index=True
+    )
+    n_points = len(trajectories)
+
+    start = time.perf_counter()
+    labels = phase_labels(trajectories)
+    duration = time.perf_counter() - start
+    print(
+        f"{trajectories['flight_id'].nunique()} flights, {n_points} points in {duration:.2f}s "
+        f"({n_points / duration:.0f} points/s)"
+    )
+    print(pd.Series(labels).value_counts(normalize=True).to_string())
+
+    try:
+        import openap.phase  # noqa: F401
+    except ImportError:
+        print("openap is not installed, skipping the agreement check.")
+        return
+
+    # agreement with openap on a sample of flights
+    flight_ids = trajectories["flight_id"].unique()
+    rng = np.random.default_rng(0)
+    sample = rng.choice(
+        flight_ids, min(AGREEMENT_SAMPLE, len(flight_ids)), replace=False
+    )
+    sampled = trajectories["flight_id"].isin(sample).values
+    batch = labels[sampled]
+    start = time.perf_counter()
+    reference = np.concatenate(
+        [
+            PHASE_NAMES[openap_phases(trajectory)]
+            for _, trajectory in trajectories[sampled].groupby("flight_id", sort=True)
+        ]
+    )
+    duration = time.perf_counter() - start
+    print(
+        f"openap: {len(reference)} points of {len(sample)} flights in {duration:.2f}s "
+        f"({len(reference) / duration:.0f} points/s)"
+    )
+    print(f"agreement: {np.mean(batch == reference):.4%} of the points")
+    confusion = pd.crosstab(
+        pd.Series(reference, name="openap"), pd.Series(batch, name="batch")
+    )
+    print(confusion.to_string())
+
+
+if __name__ == "__main__":
+    sys.path.append(str(root_dir))
+    main()
@@ -2,9 +2,7 @@ import pandas as pd
 from utils.dataset import Dataset
 from pathlib import Path
 from preprocessing.base_preprocessor import BasePreprocessor
-
-# import batchprocessing script
-# from preprocessing.trajectory_batchprocessing import create_trajectory_features_batch
+from preprocessing.trajectory_feature_store import TrajectoryFeatureStore, store_dir
 
 root_dir = Path(__file__).parent.parent.absolute()
 additional_data_dir = root_dir / "additional_data"
@@ -13,27 +11,57 @@ trajectory_data_file = (
 )
 
 
+def load_trajectory_features(flight_ids) -> pd.DataFrame:
+    # prefer the feature store, it is always at least as recent as all_trajectory_features.parquet
+    if (store_dir / "manifest.parquet").exists():
+        return TrajectoryFeatureStore().read_features(flight_ids)
+    return pd.read_parquet(trajectory_data_file)
+
+
+def store_settings(store: TrajectoryFeatureStore) -> tuple:
+    # (engine, resample) the store was built with, taken from the versions of its flights, e.g. "numpy-4-resampled30"
+    if len(store) == 0:
+        # the default of the batch job, all_trajectory_features.parquet files from before the store are traffic features
+        return "traffic", None
+    version = store.manifest["version"].mode().iloc[0]
+    engine, _, *resampled = version.split("-")
+    resample = float(resampled[0].removeprefix("resampled")) if resampled else None
+    return engine, resample
+
+
 class TrajectoryPreprocessor(BasePreprocessor):
+    def cache_dependencies(self) -> list:
+        # the batch job rewrites the features without a code change here
+        return [store_dir / "manifest.parquet", trajectory_data_file]
+
     def process(self, dataset: Dataset) -> Dataset:
         # check if the additional data directory contains the trajectory data
-        if not trajectory_data_file.exists():
+        if not trajectory_data_file.exists() and not store_dir.exists():
             raise ValueError(
                 "TrajectoryPreprocessor: Trajectory data not found. Run batch processing script to create the features."
             )
 
         print("TrajectoryPreprocessor: Loading trajectory data.")
-        trajectory_features = pd.read_parquet(trajectory_data_file)
+        flight_ids = dataset.df["flight_id"].unique()
+        trajectory_features = load_trajectory_features(flight_ids)
 
         # check if all flight_ids in the dataset are in the trajectory features
-        # if not, run the batch processing script again (this could only happen if the input dataset is changed and new trajectories are available)
-        if not set(dataset.df["flight_id"]).issubset(
-            set(trajectory_features["flight_id"])
-        ):
+        # if not, run the batch processing again (this could only happen if the input dataset is changed and new trajectories are available)
+        # the feature store only computes the flights that are missing or stale, the other ones are kept
+        if not set(flight_ids).issubset(set(trajectory_features["flight_id"])):
             print(
-                "TrajectoryPreprocessor: Not all flight_ids in the dataset are in the trajectory features. Run batch processing script again to create the features."
+                "TrajectoryPreprocessor: Not all flight_ids in the dataset are in the trajectory features. Computing the missing ones."
+            )
+            from preprocessing.trajectory_batchprocessing import (
+                create_trajectory_features_batch,
+            )
+
+            # with the engine (and resampling) of the store, so the missing flights get the same feature definitions
+            engine, resample = store_settings(TrajectoryFeatureStore())
+            create_trajectory_features_batch(
+                engine=engine, merge=False, resample=resample
             )
-            # create_trajectory_features_batch()
-            trajectory_features = pd.read_parquet(trajectory_data_file)
+            trajectory_features = load_trajectory_features(flight_ids)
 
         # add the features to the dataset, matching on the flight_id
         dataset.df = dataset.df.merge(trajectory_features, on="flight_id")
@@ -0,0 +1,92 @@
+#
+# Optional stage level profiling of the trajectory batch job
+# With profiling enabled (--profile), every stage of the feature extraction records its wall time and number of points,
+# per flight for the traffic engine and per chunk for the numpy engine. The workers hand their records back with every bundle,
+# StageProfile aggregates them across the pool and reports percentiles per stage and the slowest flights per day and per run.
+#
+
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+SLOWEST_FLIGHTS = 10  # flights listed in the reports
+
+enabled = False
+# (flight_id, stage, seconds, points) of the stages that ran in this process since the last drain
+# flight_id is -1 for stages that run on a whole chunk
+_records = []
+
+
+def enable(on: bool = True) -> None:
+    global enabled
+    enabled = on
+
+
+@contextmanager
+def stage(name: str, flight_id: int = -1, points: int = 0):
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _records.append((int(flight_id), name, time.perf_counter() - start, points))
+
+
+def drain() -> list:
+    # the records of this process since the last call
+    global _records
+    records, _records = _records, []
+    return records
+
+
+class StageProfile:
+    def __init__(self) -> None:
+        self.records = {}  # key (day) -> records
+
+    def add(self, key, records: list) -> None:
+        if records:
+            self.records.setdefault(key, []).extend(records)
+
+    def frame(self, key=None) -> pd.DataFrame:
+        if key is None:
+            records = [r for records in self.records.values() for r in records]
+        else:
+            records = self.records.get(key, [])
+        return pd.DataFrame(
+            records, columns=["flight_id", "stage", "seconds", "points"]
+        )
+
+    def report(self, key=None) -> str:
+        # percentiles of the wall time per stage and the slowest flights, for one key or the whole run
+        frame = self.frame(key)
+        if frame.empty:
+            return "no profiling records"
+        stages = frame.groupby("stage", sort=False).agg(
+            count=("seconds", "size"),
+            total_s=("seconds", "sum"),
+            p50_ms=("seconds", lambda s: np.percentile(s, 50) * 1000),
+            p90_ms=("seconds", lambda s: np.percentile(s, 90) * 1000),
+            p99_ms=("seconds", lambda s: np.percentile(s, 99) * 1000),
+            max_ms=("seconds", lambda s: s.max() * 1000),
+            points=("points", "sum"),
+        )
+        # "task" is the whole task, the other stages are parts of it
+        stage_total = stages.loc[stages.index != "task", "total_s"].sum()
+        stages["share"] = stages["total_s"] / max(stage_total, 1e-9)
+        stages.loc[stages.index == "task", "share"] = np.nan
+        stages["points_per_s"] = stages["points"] / stages["total_s"].clip(lower=1e-9)
+        stages = stages.sort_values("total_s", ascending=False)
+
+        report = stages.to_string(float_format=lambda x: f"{x:.3f}")
+        # the numpy engine has no per flight tasks
+        flights = frame[(frame["stage"] == "task") & (frame["flight_id"] >= 0)]
+        if len(flights):
+            slowest = flights.nlargest(SLOWEST_FLIGHTS, "seconds")
+            report += "\nslowest flights:\n" + slowest[
+                ["flight_id", "seconds", "points"]
+            ].to_string(index=False)
+        return report
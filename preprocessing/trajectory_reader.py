@@ -0,0 +1,138 @@
+#
+# Streaming reader for the daily OSN trajectory files
+# Only the columns used by the trajectory features are read, with compact dtypes, and complete flights are yielded batch by batch.
+# The files are sorted by time, so a flight spans many batches: a cheap first pass over the flight_id column finds the last batch
+# of every flight, the second pass keeps the points of unfinished flights until that batch has been read.
+# Peak memory is therefore bounded by the flights that are in the air at the same time, not by the size of the file.
+# Days that were indexed (trajectory_index.py) are Arrow IPC files sorted by flight_id, they are memory mapped and cut at
+# flight boundaries instead.
+#
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+READ_BATCH_ROWS = 1_000_000  # rows decoded at once
+
+# columns used by the trajectory features and the dtype they are read with
+TRAJECTORY_COLUMNS = {
+    "timestamp": None,  # kept as is
+    "flight_id": pa.int32(),
+    "latitude": pa.float32(),
+    "longitude": pa.float32(),
+    "altitude": pa.float32(),
+    "groundspeed": pa.float32(),
+    "track": pa.float32(),
+    "vertical_rate": pa.float32(),
+    "u_component_of_wind": pa.float32(),
+    "v_component_of_wind": pa.float32(),
+}
+
+
+def _cast(batch: pa.RecordBatch) -> pd.DataFrame:
+    columns = []
+    for name, column in zip(batch.schema.names, batch.columns):
+        dtype = TRAJECTORY_COLUMNS.get(name)
+        # safe cast, so a flight_id that does not fit into int32 raises instead of wrapping around
+        columns.append(column if dtype is None else column.cast(dtype, safe=True))
+    return pa.Table.from_arrays(columns, names=batch.schema.names).to_pandas()
+
+
+def _flight_filter(flight_id_type: pa.DataType, flight_ids) -> pa.Array:
+    # the wanted flight_ids as an arrow array with the type of the file, for pc.is_in
+    flight_ids = np.fromiter(flight_ids, dtype=np.int64)
+    return pa.array(flight_ids).cast(flight_id_type)
+
+
+def last_batch_per_flight(
+    parquet_file: pq.ParquetFile, batch_rows: int = READ_BATCH_ROWS, value_set=None
+) -> pd.Series:
+    # number of the last batch that contains a point of the flight, indexed by flight_id
+    last = {}
+    for i, batch in enumerate(
+        parquet_file.iter_batches(batch_size=batch_rows, columns=["flight_id"])
+    ):
+        column = batch.column(0)
+        if value_set is not None:
+            column = column.filter(pc.is_in(column, value_set=value_set))
+        flight_ids = np.unique(column.to_numpy(zero_copy_only=False))
+        last.update(dict.fromkeys(flight_ids.tolist(), i))
+    return pd.Series(last, dtype=np.int64)
+
+
+def read_flights(date_file: Path, flight_ids=None, batch_rows: int = READ_BATCH_ROWS):
+    # yields frames of complete flights (sorted by flight_id, original point order within a flight)
+    # with flight_ids, only these flights are read: every batch is filtered against an arrow hash set before it is converted
+    if Path(date_file).suffix == ".arrow":
+        yield from read_ipc_flights(date_file, flight_ids, batch_rows)
+        return
+    parquet_file = pq.ParquetFile(date_file)
+    columns = [c for c in TRAJECTORY_COLUMNS if c in parquet_file.schema_arrow.names]
+    value_set = None
+    if flight_ids is not None:
+        value_set = _flight_filter(
+            parquet_file.schema_arrow.field("flight_id").type, flight_ids
+        )
+    last_batch = last_batch_per_flight(parquet_file, batch_rows, value_set)
+
+    pending = None
+    for i, batch in enumerate(
+        parquet_file.iter_batches(batch_size=batch_rows, columns=columns)
+    ):
+        if value_set is not None:
+            batch = batch.filter(
+                pc.is_in(batch.column("flight_id"), value_set=value_set)
+            )
+        frame = _cast(batch)
+        pending = frame if pending is None else pd.concat([pending, frame])
+        finished = pending["flight_id"].map(last_batch).values == i
+        if finished.any():
+            yield pending[finished].sort_values(
+                "flight_id", kind="stable", ignore_index=True
+            )
+            pending = pending[~finished]
+
+
+def read_ipc_flights(
+    ipc_file: Path, flight_ids=None, batch_rows: int = READ_BATCH_ROWS
+):
+    # same as read_flights for an arrow ipc file that is sorted by flight_id, frames of about batch_rows points
+    # the file is memory mapped and the table is cut at flight boundaries before it is filtered, so only the chunk
+    # that is yielded is copied into memory, and only the pages of the used columns and flights are read from disk
+    table = pa.ipc.open_file(pa.memory_map(str(ipc_file))).read_all()
+    table = table.select([c for c in TRAJECTORY_COLUMNS if c in table.column_names])
+    flight_id = table["flight_id"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, flight_id[1:] != flight_id[:-1]])
+    ends = np.r_[starts[1:], len(flight_id)]
+    value_set = None
+    if flight_ids is not None:
+        value_set = _flight_filter(table.schema.field("flight_id").type, flight_ids)
+        wanted = pc.is_in(
+            pa.array(flight_id[starts]).cast(value_set.type), value_set=value_set
+        )
+        wanted = wanted.to_numpy(zero_copy_only=False)
+        starts, ends = starts[wanted], ends[wanted]
+    if len(starts) == 0:
+        return
+    # a new chunk starts at the flight in which every multiple of batch_rows wanted points falls
+    before = np.cumsum(ends - starts) - (ends - starts)
+    chunk = before // batch_rows
+    first = np.flatnonzero(np.r_[True, chunk[1:] != chunk[:-1]])
+    last = np.r_[first[1:], len(starts)] - 1
+    for i, j in zip(first, last):
+        part = table.slice(starts[i], ends[j] - starts[i])
+        if value_set is not None:
+            part = part.filter(pc.is_in(part["flight_id"], value_set=value_set))
+        yield _cast(part)
+
+
+def read_trajectories(date_file: Path, flight_ids=None) -> pd.DataFrame:
+    # the whole day at once, with the same columns and dtypes as read_flights
+    frames = list(read_flights(date_file, flight_ids))
+    if not frames:
+        return pd.DataFrame(columns=list(TRAJECTORY_COLUMNS))
+    return pd.concat(frames, ignore_index=True)
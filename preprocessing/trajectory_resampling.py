@@ -0,0 +1,93 @@
+#
+# Optional decimation of the trajectories ahead of the feature extraction (--resample SECONDS in the batch job)
+# The OSN trajectories are sampled irregularly and often every few seconds, while every step of the feature extraction
+# scales with the number of points. Above DENSE_ALTITUDE_FT only the first point of every interval of the flight is kept,
+# below (taxi, takeoff, initial climb, approach and landing) all points are kept, as the takeoff features look at
+# consecutive points. The first and last point of every flight are always kept.
+# Points are selected, not interpolated, so the kept points are original measurements.
+#
+# Usage (features of one day at full resolution and resampled, with the throughput and the agreement of every feature):
+#   python ./preprocessing/trajectory_resampling.py data/2022-01-01.parquet 30
+#
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+root_dir = Path(__file__).parent.parent.absolute()
+
+DENSE_ALTITUDE_FT = 10000  # all points below this altitude are kept
+RESAMPLE_INTERVAL_S = 30  # default interval above DENSE_ALTITUDE_FT
+
+
+def decimation_mask(time_s, altitude, group, interval_s: float) -> np.ndarray:
+    # True for the points that are kept, the points have to be sorted by group and by time within a group
+    n_points = len(group)
+    if n_points == 0:
+        return np.zeros(0, dtype=bool)
+    new_flight = np.r_[True, group[1:] != group[:-1]]
+    starts = np.flatnonzero(new_flight)
+    counts = np.diff(np.r_[starts, n_points])
+    # points without altitude are kept as well
+    sparse = altitude >= DENSE_ALTITUDE_FT
+    # interval number since the first point of the flight, a new interval starts whenever the flight leaves the dense zone
+    bucket = np.floor((time_s - np.repeat(time_s[starts], counts)) / interval_s)
+    new_run = (
+        new_flight
+        | np.r_[True, sparse[1:] != sparse[:-1]]
+        | np.r_[True, bucket[1:] != bucket[:-1]]
+    )
+    last_point = np.r_[new_flight[1:], True]
+    return ~sparse | new_run | last_point
+
+
+def decimate(trajectories: pd.DataFrame, interval_s: float) -> pd.DataFrame:
+    # the kept points of a frame sorted by flight_id (and by time within a flight)
+    flight_ids = trajectories["flight_id"].values
+    group = np.cumsum(np.r_[False, flight_ids[1:] != flight_ids[:-1]])
+    timestamps = trajectories["timestamp"].values.astype("datetime64[ns]")
+    keep = decimation_mask(
+        timestamps.astype(np.int64) / 1e9,
+        trajectories["altitude"].to_numpy(dtype=np.float64, na_value=np.nan),
+        group,
+        interval_s,
+    )
+    return trajectories[keep].reset_index(drop=True)
+
+
+def main() -> None:
+    from preprocessing.trajectory_batchprocessing import load_flight_lookup
+    from preprocessing.trajectory_engine import (
+        compare_features,
+        create_trajectory_features_day,
+    )
+    from preprocessing.trajectory_reader import read_trajectories
+
+    date_file = Path(sys.argv[1])
+    interval_s = float(sys.argv[2]) if len(sys.argv) > 2 else RESAMPLE_INTERVAL_S
+    flight_lookup = load_flight_lookup()
+    trajectories = read_trajectories(date_file, flight_lookup)
+
+    start = time.perf_counter()
+    full = create_trajectory_features_day(trajectories, flight_lookup)
+    full_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    resampled_trajectories = decimate(trajectories, interval_s)
+    resampled = create_trajectory_features_day(resampled_trajectories, flight_lookup)
+    resampled_s = time.perf_counter() - start
+
+    print(
+        f"{len(full)} flights, {len(trajectories)} points in {full_s:.1f}s at full resolution, "
+        f"{len(resampled_trajectories)} points ({len(resampled_trajectories) / max(len(trajectories), 1):.0%}) "
+        f"in {resampled_s:.1f}s resampled to {interval_s:g}s ({full_s / max(resampled_s, 1e-9):.1f}x)"
+    )
+    print(compare_features(resampled, full).to_string())
+
+
+if __name__ == "__main__":
+    sys.path.append(str(root_dir))
+    main()
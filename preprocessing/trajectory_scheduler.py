@@ -0,0 +1,252 @@
+#
+# Scheduling of the trajectory tasks on the worker pool
+# The tasks of a chunk are sorted by their number of points and handed out longest first, the short ones packed into bundles,
+# so the long intercontinental flights do not end up as the tail of a chunk that keeps the rest of the pool waiting.
+# The bundles are collected in the order they finish, and the bundles of the next chunks are submitted while the previous
+# chunk is still running, so the pool never waits for a whole chunk or day.
+# Every task runs isolated: an exception or a timeout only drops the flight(s) concerned, which are returned as failures.
+#
+
+import os
+import signal
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from itertools import count
+from pathlib import Path
+from queue import Queue
+
+import numpy as np
+import pandas as pd
+
+from preprocessing import trajectory_profiling
+
+BUNDLES_PER_WORKER = 4  # bundles per worker and chunk, smaller bundles balance better but cost more overhead
+IN_FLIGHT_PER_WORKER = 2  # bundles submitted per worker before waiting for results
+TASK_TIMEOUT_S = 300  # a single task taking longer than this is stopped and recorded as failed, None for no limit
+MIN_RETRY_TIMEOUT_S = 10  # least time of a flight retried alone, see run_isolated
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+def task_points(task: tuple) -> int:
+    # the trajectory slice is the last argument of every task
+    return len(task[-1])
+
+
+def schedule_bundles(tasks: list, workers: int) -> list:
+    # longest first: every bundle holds roughly the same number of points, so long flights are a bundle of their own
+    # and the short ones are packed together
+    if not tasks:
+        return []
+    points = np.array([task_points(task) for task in tasks])
+    order = np.argsort(-points, kind="stable")
+    target = points.sum() / max(workers * BUNDLES_PER_WORKER, 1)
+    bundles, bundle, bundle_points = [], [], 0
+    for i in order:
+        bundle.append(tasks[i])
+        bundle_points += points[i]
+        if bundle_points >= target:
+            bundles.append(bundle)
+            bundle, bundle_points = [], 0
+    if bundle:
+        bundles.append(bundle)
+    return bundles
+
+
+@contextmanager
+def time_limit(seconds):
+    # raises TaskTimeout in the block after seconds, only where SIGALRM is available (the main thread of a unix process)
+    if (
+        not seconds
+        or not hasattr(signal, "SIGALRM")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        yield
+        return
+
+    def timeout(signum, frame):
+        raise TaskTimeout(f"task exceeded {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def failed_stage(e: BaseException) -> str:
+    # innermost function of the feature code in the traceback, e.g. get_initial_climb_trajectory
+    frames = traceback.extract_tb(e.__traceback__)
+    here = Path(__file__).parent
+    ours = [
+        frame
+        for frame in frames
+        if Path(frame.filename).parent == here
+        and Path(frame.filename).name != Path(__file__).name
+    ]
+    frames = ours or frames
+    return frames[-1].name if frames else "unknown"
+
+
+def run_isolated(worker_function, task: tuple, timeout=TASK_TIMEOUT_S) -> tuple:
+    # results and failures of one task, a failing task of several flights is split up to find the flights that fail
+    # the flights of a split task share its timeout by their number of points, so the retries of a task that timed out
+    # take about one more timeout in total and not one per flight
+    trajectory = task[-1]
+    flight_ids = trajectory["flight_id"].unique()
+    flight_id = flight_ids[0] if len(flight_ids) == 1 else -1
+    try:
+        with time_limit(timeout), trajectory_profiling.stage(
+            "task", flight_id, len(trajectory)
+        ):
+            return [worker_function(*task)], []
+    except Exception as e:
+        if len(flight_ids) > 1:
+            results, failures = [], []
+            for _, flight in trajectory.groupby("flight_id", sort=False):
+                flight_timeout = timeout and max(
+                    timeout * len(flight) / len(trajectory),
+                    min(MIN_RETRY_TIMEOUT_S, timeout),
+                )
+                flight_results, flight_failures = run_isolated(
+                    worker_function, task[:-1] + (flight,), flight_timeout
+                )
+                results += flight_results
+                failures += flight_failures
+            return results, failures
+        failure = {
+            "flight_id": int(flight_id),
+            "stage": failed_stage(e),
+            "exception": f"{type(e).__name__}: {e}",
+            "points": len(trajectory),
+        }
+        return [], [failure]
+
+
+def run_bundle(worker_function, bundle: list, timeout=TASK_TIMEOUT_S) -> tuple:
+    # runs in a pool worker: the results and failures of all tasks of the bundle, the profiling records of the worker,
+    # the worker and how long it was busy
+    start = time.perf_counter()
+    results, failures = [], []
+    for task in bundle:
+        task_results, task_failures = run_isolated(worker_function, task, timeout)
+        results += task_results
+        failures += task_failures
+    busy = time.perf_counter() - start
+    points = sum(task_points(task) for task in bundle)
+    return results, failures, trajectory_profiling.drain(), os.getpid(), busy, points
+
+
+class WorkerUtilisation:
+    # busy time of every worker process, compared with the wall time since the pool started
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.start = time.perf_counter()
+        self.stats = {}  # pid -> [busy seconds, bundles, points]
+
+    def add(self, pid: int, busy: float, points: int) -> None:
+        stats = self.stats.setdefault(pid, [0.0, 0, 0])
+        stats[0] += busy
+        stats[1] += 1
+        stats[2] += points
+
+    def table(self) -> pd.DataFrame:
+        elapsed = time.perf_counter() - self.start
+        table = pd.DataFrame.from_dict(
+            self.stats, orient="index", columns=["busy_s", "bundles", "points"]
+        )
+        table.index.name = "pid"
+        table["utilisation"] = table["busy_s"] / elapsed
+        return table.sort_index()
+
+    def summary(self) -> str:
+        table = self.table()
+        # workers that never got a bundle count as idle
+        utilisation = np.r_[
+            table["utilisation"].values, np.zeros(self.workers - len(table))
+        ]
+        return (
+            f"{len(table)}/{self.workers} workers used, utilisation "
+            f"mean {utilisation.mean():.0%} min {utilisation.min():.0%} max {utilisation.max():.0%}, "
+            f"{table['points'].sum() / (time.perf_counter() - self.start):.0f} points/s"
+        )
+
+
+def run_unordered(
+    pool,
+    stream,
+    worker_function,
+    utilisation: WorkerUtilisation,
+    workers: int,
+    profile: trajectory_profiling.StageProfile = None,
+):
+    # stream yields (key, prepared) for every chunk, prepared[0] being its tasks, and (key, None) once all chunks of a key were read
+    # yields (key, prepared, results, failures) once all bundles of a chunk are back (results in the order they finished)
+    # and (key, None, None, None) once all chunks of a key were yielded
+    done = Queue()
+    chunk_ids = count()
+    chunks = {}  # chunk id -> [key, prepared, results, failures, open bundles]
+    open_chunks = {}  # key -> chunks of the key that are not yielded yet
+    complete = set()  # keys whose chunks were all read from the stream
+    in_flight = 0
+    max_in_flight = max(workers * IN_FLIGHT_PER_WORKER, 1)
+
+    def key_done(key):
+        if key in complete and not open_chunks.get(key):
+            complete.discard(key)
+            open_chunks.pop(key, None)
+            return [(key, None, None, None)]
+        return []
+
+    def collect_next():
+        # wait for the next bundle to finish, returns what can be yielded now
+        nonlocal in_flight
+        chunk_id, result = done.get()
+        in_flight -= 1
+        if isinstance(result, BaseException):
+            raise result
+        results, failures, records, pid, busy, points = result
+        utilisation.add(pid, busy, points)
+        chunk = chunks[chunk_id]
+        if profile is not None:
+            profile.add(chunk[0], records)
+        chunk[2].extend(results)
+        chunk[3].extend(failures)
+        chunk[4] -= 1
+        if chunk[4]:
+            return []
+        del chunks[chunk_id]
+        key = chunk[0]
+        open_chunks[key] -= 1
+        return [tuple(chunk[:4])] + key_done(key)
+
+    for key, prepared in stream:
+        if prepared is None:
+            complete.add(key)
+            yield from key_done(key)
+            continue
+        bundles = schedule_bundles(prepared[0], workers)
+        if not bundles:
+            yield key, prepared, [], []
+            continue
+        chunk_id = next(chunk_ids)
+        chunks[chunk_id] = [key, prepared, [], [], len(bundles)]
+        open_chunks[key] = open_chunks.get(key, 0) + 1
+        for bundle in bundles:
+            while in_flight >= max_in_flight:
+                yield from collect_next()
+            pool.apply_async(
+                run_bundle,
+                (worker_function, bundle),
+                callback=lambda result, chunk_id=chunk_id: done.put((chunk_id, result)),
+                error_callback=lambda e, chunk_id=chunk_id: done.put((chunk_id, e)),
+            )
+            in_flight += 1
+    while in_flight:
+        yield from collect_next()
@@ -0,0 +1,188 @@
+#
+# Compact per flight summary of the trajectory archive, for filtering flights without reading their trajectories
+# One pass over the daily files computes for every flight: first/last timestamp and position, point count, altitude range,
+# max groundspeed, bounding box, the number of gaps in the data and the number of cruise altitude points.
+# has_cruise_trajectory and whether a flight starts/ends at its airports (the airport part of has_takeoff/landing_trajectory)
+# can then be answered from a few MB, and expensive per flight processing is only scheduled for the flights that qualify:
+#
+#   summary = load_summary()
+#   flags = completeness_flags(summary, flight_lookup)
+#   candidates = flags.index[flags["starts_at_adep"]]
+#   for flights in read_flights(date_file, candidates): ...
+#
+# Usage (summarises all new or changed days in data/):
+#   python ./preprocessing/trajectory_summary.py
+#
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+root_dir = Path(__file__).parent.parent.absolute()
+trajectory_data_dir = root_dir / "data"
+summary_file = root_dir / "additional_data" / "trajectory_summary.parquet"
+
+# allow running this file as a script
+sys.path.append(str(root_dir))
+from preprocessing.trajectory_engine import (
+    FlightBatch,
+    near_airport,
+    segment_count,
+    segment_first,
+    segment_last,
+    segment_max,
+    segment_min,
+    take,
+)
+from preprocessing.trajectory_index import indexed_file
+from preprocessing.trajectory_reader import read_flights
+
+GAP_S = 120  # seconds without a point that count as a gap
+CRUISE_ALTITUDE_FT = (15000, 40000)  # same range as has_cruise_trajectory
+
+
+def summarise_flights(trajectories: pd.DataFrame) -> pd.DataFrame:
+    # one row per flight of a frame of complete flights
+    batch = FlightBatch(trajectories)
+    n = len(batch)
+    group = batch.group
+    valid_position = ~np.isnan(batch.latitude) & ~np.isnan(batch.longitude)
+    first = segment_first(valid_position, group, n)
+    last = segment_last(valid_position, group, n)
+    step = batch.time - batch.previous(batch.time)
+    cruise = (batch.altitude > CRUISE_ALTITUDE_FT[0]) & (
+        batch.altitude < CRUISE_ALTITUDE_FT[1]
+    )
+    first_time = segment_min(batch.time, group, n)
+    last_time = segment_max(batch.time, group, n)
+    return pd.DataFrame(
+        {
+            "flight_id": batch.flight_ids.astype(np.int64),
+            "points": batch.counts.astype(np.int64),
+            "first_timestamp": pd.to_datetime(first_time, unit="s", utc=True),
+            "last_timestamp": pd.to_datetime(last_time, unit="s", utc=True),
+            "first_latitude": take(batch.latitude, first),
+            "first_longitude": take(batch.longitude, first),
+            "first_altitude": take(batch.altitude, first),
+            "last_latitude": take(batch.latitude, last),
+            "last_longitude": take(batch.longitude, last),
+            "last_altitude": take(batch.altitude, last),
+            "min_altitude": segment_min(batch.altitude, group, n),
+            "max_altitude": segment_max(batch.altitude, group, n),
+            "max_groundspeed": segment_max(batch.groundspeed, group, n),
+            "min_latitude": segment_min(batch.latitude, group, n),
+            "max_latitude": segment_max(batch.latitude, group, n),
+            "min_longitude": segment_min(batch.longitude, group, n),
+            "max_longitude": segment_max(batch.longitude, group, n),
+            "gaps": segment_count(step, group, n, step > GAP_S).astype(np.int64),
+            "max_gap_s": segment_max(step, group, n),
+            "cruise_points": segment_count(batch.altitude, group, n, cruise).astype(
+                np.int64
+            ),
+        }
+    )
+
+
+def summarise_day(date_file: Path) -> pd.DataFrame:
+    frames = [summarise_flights(flights) for flights in read_flights(date_file)]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True).assign(day=Path(date_file).stem)
+
+
+def build_summary(
+    date_files: list = None, file: Path = summary_file, force: bool = False
+) -> pd.DataFrame:
+    # summarises the days that are new or changed since the summary was written, one row per flight and day
+    if date_files is None:
+        date_files = sorted(trajectory_data_dir.glob("*.parquet"))
+    summary = None
+    if file.exists() and not force:
+        summary = pd.read_parquet(file)
+        written = file.stat().st_mtime_ns
+        known = set(summary["day"])
+        date_files = [
+            date_file
+            for date_file in date_files
+            if date_file.stem not in known or date_file.stat().st_mtime_ns > written
+        ]
+    if not date_files:
+        print("All days are summarised.")
+        return summary
+
+    # the indexed file of a day is read if it is up to date, see trajectory_index.py
+    days = [summarise_day(indexed_file(date_file)) for date_file in tqdm(date_files)]
+    if summary is not None:
+        days.insert(0, summary[~summary["day"].isin([f.stem for f in date_files])])
+    summary = pd.concat([day for day in days if len(day)], ignore_index=True)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = file.with_suffix(".tmp")
+    summary.to_parquet(tmp_file, index=False)
+    tmp_file.replace(file)
+    print(f"Summarised {len(date_files)} days, {len(summary)} flights.")
+    return summary
+
+
+def combine_days(summary: pd.DataFrame) -> pd.DataFrame:
+    # one row per flight, indexed by flight_id; flights that span midnight are in the summary of both days
+    # gaps across midnight are not counted
+    summary = summary.sort_values(["flight_id", "first_timestamp"])
+    first = summary.drop_duplicates("flight_id", keep="first").set_index("flight_id")
+    last = summary.drop_duplicates("flight_id", keep="last").set_index("flight_id")
+    grouped = summary.groupby("flight_id")
+    combined = pd.DataFrame(index=first.index)
+    for column in summary.columns.drop(["flight_id", "day"]):
+        if column.startswith("first_"):
+            combined[column] = first[column]
+        elif column.startswith("last_"):
+            combined[column] = last[column]
+        elif column.startswith("min_"):
+            combined[column] = grouped[column].min()
+        elif column.startswith("max_"):
+            combined[column] = grouped[column].max()
+        else:
+            combined[column] = grouped[column].sum()
+    return combined
+
+
+def load_summary(file: Path = summary_file) -> pd.DataFrame:
+    # the summary with one row per flight, indexed by flight_id
+    return combine_days(pd.read_parquet(file))
+
+
+def completeness_flags(summary: pd.DataFrame, flight_lookup: dict) -> pd.DataFrame:
+    # coarse filters for the flights of the flight lookup that are in the summary (indexed by flight_id):
+    # has_cruise is exact, starts_at_adep/ends_at_ades is the airport check of has_takeoff/landing_trajectory,
+    # which additionally need a climb/descent phase in the first/last hour
+    summary = summary[summary.index.isin(list(flight_lookup))]
+    info = [flight_lookup[flight_id] for flight_id in summary.index.tolist()]
+
+    def at_airport(prefix, codes):
+        return near_airport(
+            summary[f"{prefix}_latitude"].values,
+            summary[f"{prefix}_longitude"].values,
+            summary[f"{prefix}_altitude"].values,
+            codes,
+        )
+
+    return pd.DataFrame(
+        {
+            "starts_at_adep": at_airport("first", [adep for adep, _, _ in info]),
+            "ends_at_ades": at_airport("last", [ades for _, ades, _ in info]),
+            "has_cruise": summary["cruise_points"].values > 0,
+        },
+        index=summary.index,
+    )
+
+
+def main() -> None:
+    summary = build_summary()
+    if summary is not None:
+        print(combine_days(summary).describe().T.to_string())
+
+
+if __name__ == "__main__":
+    main()
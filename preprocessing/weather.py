@@ -39,6 +39,8 @@ cols = [
 
 
 class WeatherDataPreprocessor(BasePreprocessor):
+    def cache_dependencies(self) -> list:
+        return [root_dir / "additional_data" / "weather_data" / "all_weather.tsv"]
 
     @cache
     def weather_data(self):
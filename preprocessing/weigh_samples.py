@@ -12,6 +12,9 @@ class SampleWeightPreprocessor(BasePreprocessor):
         super().__init__(no_cache)
         self.max_weight_ratio = max_weight_ratio
 
+    def cache_config(self) -> dict:
+        return {"max_weight_ratio": self.max_weight_ratio}
+
     def process(self, dataset: Dataset) -> Dataset:
         print("Adding sample weights")
 
@@ -42,22 +42,23 @@ parser.add_argument(
 )
 args = parser.parse_args()
 
-# NOTE: We set no_cache=True to avoid confusion around caching during inference.
+# the outputs are cached by content (input, arguments, code and data files), see preprocessing/preprocessor_cache.py
+# so the cache is safe for training and submit.py, pass no_cache=True to a preprocessor to bypass it
 PREPROCESSORS: List[BasePreprocessor] = [
-    AirportPreprocessor(no_cache=True),
-    OpenAPAircraftPerformancePreprocessor(no_cache=True),
-    AircraftPerformancePreprocessor(no_cache=True),
-    FuelPricePreprocessor(no_cache=True),
-    RunwayInfoPreprocessor(no_cache=True),
-    PaxFlowPreprocessor(no_cache=True),
-    WeatherDataPreprocessor(no_cache=True),
-    WeatherSafetyFeatures(no_cache=True),
-    DerivedFeaturePreprocessor(no_cache=True),
-    TrajectoryPreprocessor(no_cache=True),
-    OpenAPFuelFlowPreprocessor(no_cache=True),
-    FeatureEngineeringPreprocessor(no_cache=True),
-    CreativeWeightPreprocessor(no_cache=True),
-    CleanDatasetPreprocessor(no_cache=True),
+    AirportPreprocessor(),
+    OpenAPAircraftPerformancePreprocessor(),
+    AircraftPerformancePreprocessor(),
+    FuelPricePreprocessor(),
+    RunwayInfoPreprocessor(),
+    PaxFlowPreprocessor(),
+    WeatherDataPreprocessor(),
+    WeatherSafetyFeatures(),
+    DerivedFeaturePreprocessor(),
+    TrajectoryPreprocessor(),
+    OpenAPFuelFlowPreprocessor(),
+    FeatureEngineeringPreprocessor(),
+    CreativeWeightPreprocessor(),
+    CleanDatasetPreprocessor(),
 ]
 
 model_config = {